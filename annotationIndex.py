@@ -0,0 +1,230 @@
+import os
+import json
+import shutil
+import numpy as np
+from cocoIdGenerator import decodeImageId
+
+"""
+====================================================================================================
+
+    Columnar annotation index of a (merged) coco json, used by CustomCocoDataset
+      - loadAnnotationIndex
+          if you want the index of a coco json (compiled the first time, and again when the coco json changes)
+      - compileAnnotationIndex
+          if you want to compile the index of a coco json yourself
+
+    The index is a directory of .npy files, one array for every field:
+        images (sorted by image id):
+            image_ids.npy - int64, image id
+            file_names.npy - unicode, frame filename
+            widths.npy, heights.npy - int32, size of the frame in pixel
+            ann_offsets.npy - int64, one more than the number of images,
+                the annotations of the image at position i are the rows ann_offsets[i] to ann_offsets[i + 1]
+            file_ids.npy - int64, file id decoded from the image id (see CocoIdGenerator),
+                -1 if the image id cannot be trusted to decode to the file of the image (see getDecodedFileIds)
+        annotations (grouped by image, in the order of the coco json):
+            ann_ids.npy - int64, annotation id
+            boxes.npy - float32, number of annotations x 4, coco bbox [xmin, ymin, width, height]
+            boxes_xyxy.npy - float32, number of annotations x 4, the same boxes as [xmin, ymin, xmax, ymax]
+            category_ids.npy - int64
+            areas.npy - float32
+            iscrowd.npy - int64
+    and source.json, the size and modification time of the coco json it got compiled from
+      (and the ANNOTATION_INDEX_VERSION it got compiled with)
+
+    The arrays are memory mapped, so getting the targets of an image is slicing, without parsing anything,
+      and DataLoader workers forked from the same process share the pages
+
+====================================================================================================
+"""
+
+ANNOTATION_INDEX_FIELDS = ["image_ids", "file_names", "widths", "heights", "ann_offsets", "file_ids",
+                            "ann_ids", "boxes", "boxes_xyxy", "category_ids", "areas", "iscrowd"]
+
+# bumped whenever the fields of the index change, so an index compiled by an older version gets compiled again
+ANNOTATION_INDEX_VERSION = 3
+
+
+class AnnotationIndex:
+    """
+    Annotation Index gives access to the arrays of a compiled annotation index (see compileAnnotationIndex)
+
+    Every field in ANNOTATION_INDEX_FIELDS is an attribute, memory mapped (read only)
+
+    Only the index directory gets pickled (e.g. when a dataset gets sent to the DataLoader worker processes),
+      every process maps the arrays itself, so the arrays are never copied between processes
+
+    Parameters:
+        index_dir - string, path to the directory of the compiled index
+    """
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+
+        for field in ANNOTATION_INDEX_FIELDS:
+            setattr(self, field, np.load(os.path.join(index_dir, field + ".npy"), mmap_mode="r"))
+
+
+    """
+    Return the positions (in the image arrays) of the images with the ids in {img_ids}, as an int64 array
+    """
+    def getImagePositions(self, img_ids):
+        img_ids = np.asarray(img_ids, dtype=np.int64)
+        positions = np.searchsorted(self.image_ids, img_ids)
+
+        found = positions < len(self.image_ids)
+        found[found] = self.image_ids[positions[found]] == img_ids[found]
+        if not found.all():
+            raise KeyError(f"image ids {img_ids[~found][:10].tolist()} are not in the annotation index = {self.index_dir}")
+
+        return positions
+
+
+    def __len__(self):
+        return len(self.image_ids)
+
+
+    def __getstate__(self):
+        return {"index_dir": self.index_dir}
+
+
+    def __setstate__(self, state):
+        self.__init__(state["index_dir"])
+
+
+"""
+Return the annotation index of the coco json at {coco_json_path}
+
+The index is saved in the directory next to the coco json (see getAnnotationIndexDir),
+    it gets compiled the first time, and compiled again if the coco json changed (size or modification time) since then
+"""
+def loadAnnotationIndex(coco_json_path):
+    index_dir = getAnnotationIndexDir(coco_json_path)
+
+    if not isAnnotationIndexUpToDate(coco_json_path, index_dir):
+        compileAnnotationIndex(coco_json_path, index_dir)
+
+    return AnnotationIndex(index_dir)
+
+
+"""
+Compile the coco json at {coco_json_path} to a columnar annotation index in {index_dir}
+
+The index is written to a temporary directory first and then renamed,
+    so a dataset never opens a half written index
+"""
+def compileAnnotationIndex(coco_json_path, index_dir):
+    print(f"Compiling annotation index of {coco_json_path} to {index_dir}")
+
+    coco_stat = os.stat(coco_json_path)
+    with open(coco_json_path, "r") as f:
+        coco_json = json.load(f)
+
+    images = sorted(coco_json["images"], key=lambda img: img["id"])
+    image_ids = np.array([img["id"] for img in images], dtype=np.int64)
+
+    annotations = coco_json["annotations"]
+    ann_image_ids = np.array([ann["image_id"] for ann in annotations], dtype=np.int64)
+
+    # group the annotations by image, keeping the order of the coco json within an image
+    ann_positions = np.searchsorted(image_ids, ann_image_ids)
+    order = np.argsort(ann_positions, kind="stable")
+    boxes = np.array([ann["bbox"] for ann in annotations], dtype=np.float32).reshape(-1, 4)[order]
+    file_names = [img["file_name"] for img in images]
+
+    arrays = {
+                "image_ids": image_ids,
+                "file_names": np.array(file_names, dtype=np.str_),
+                "widths": np.array([img["width"] for img in images], dtype=np.int32),
+                "heights": np.array([img["height"] for img in images], dtype=np.int32),
+                "ann_offsets": np.concatenate([[0], np.cumsum(np.bincount(ann_positions, minlength=len(images)))]).astype(np.int64),
+                "file_ids": getDecodedFileIds(image_ids, file_names),
+                "ann_ids": np.array([ann["id"] for ann in annotations], dtype=np.int64)[order],
+                "boxes": boxes,
+                "boxes_xyxy": np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1),
+                "category_ids": np.array([ann["category_id"] for ann in annotations], dtype=np.int64)[order],
+                "areas": np.array([ann["area"] for ann in annotations], dtype=np.float32)[order],
+                "iscrowd": np.array([ann.get("iscrowd", 0) for ann in annotations], dtype=np.int64)[order],
+             }
+
+    tmp_dir = f"{index_dir}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    for field in ANNOTATION_INDEX_FIELDS:
+        np.save(os.path.join(tmp_dir, field + ".npy"), arrays[field])
+
+    with open(os.path.join(tmp_dir, "source.json"), "w") as f:
+        json.dump({"size": coco_stat.st_size, "mtime": coco_stat.st_mtime_ns, "version": ANNOTATION_INDEX_VERSION}, f)
+
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+    os.replace(tmp_dir, index_dir)
+
+
+"""
+====================================================================================================
+
+    Helper functions
+
+====================================================================================================
+"""
+
+"""
+Return the directory of the annotation index of the coco json at {coco_json_path}
+
+    e.g. "./merged_coco_annotation/merged_coco.json" -> "./merged_coco_annotation/merged_coco_index"
+"""
+def getAnnotationIndexDir(coco_json_path):
+    return os.path.splitext(coco_json_path)[0] + "_index"
+
+
+"""
+Return the file id decoded from every image id in {image_ids} (int64 array), 
+    or -1 for the images whose id cannot be trusted to decode to the file of the image {file_names}
+
+The merge keeps the ids of a coco json as long as they are unique, and remaps the colliding ones above every id so far,
+    so a remapped id decodes to the file id of another coco json (e.g. a stale coco json, converted with a file id 
+    that now belongs to another via annotation, collides with that one). 
+    An image id is only trusted if
+        - its frame id is the frame number in its frame filename
+        - all the images of its coco json (the frame filenames without the frame number) decode to the same file id
+        - no other coco json decodes to that file id
+
+    e.g. "DJI_0386_2_00123.jpg" belongs to the coco json "DJI_0386_2", frame number 123
+"""
+def getDecodedFileIds(image_ids, file_names):
+    file_ids, frame_ids = decodeImageId(image_ids)
+    file_ids = file_ids.copy()
+
+    stems, frame_numbers = zip(*(os.path.splitext(file_name)[0].rsplit("_", 1) for file_name in file_names)) if file_names else ((), ())
+    frame_numbers = np.array([int(frame_number) for frame_number in frame_numbers], dtype=np.int64)
+
+    # file ids of the images of every coco json, and coco jsons of every file id
+    stem_file_ids = {}
+    file_id_stems = {}
+    for stem, file_id in zip(stems, file_ids.tolist()):
+        stem_file_ids.setdefault(stem, set()).add(file_id)
+        file_id_stems.setdefault(file_id, set()).add(stem)
+
+    trusted = frame_ids == frame_numbers
+    trusted &= np.array([len(stem_file_ids[stem]) == 1 and len(file_id_stems[file_id]) == 1 
+                            for stem, file_id in zip(stems, file_ids.tolist())], dtype=bool)
+
+    file_ids[~trusted] = -1
+    return file_ids
+
+
+"""
+Return True if the annotation index in {index_dir} got compiled from the current version of the coco json at {coco_json_path}
+    by the current ANNOTATION_INDEX_VERSION
+"""
+def isAnnotationIndexUpToDate(coco_json_path, index_dir):
+    source_path = os.path.join(index_dir, "source.json")
+    if not os.path.exists(source_path):
+        return False
+
+    with open(source_path, "r") as f:
+        source = json.load(f)
+
+    coco_stat = os.stat(coco_json_path)
+    return (source.get("version") == ANNOTATION_INDEX_VERSION 
+                and source["size"] == coco_stat.st_size and source["mtime"] == coco_stat.st_mtime_ns)
@@ -0,0 +1,170 @@
+import os
+import json
+import hashlib
+
+"""
+Constant declaration (from config file)
+"""
+with open("./config.json", "r") as f:
+  config_json = json.load(f)
+
+BUILD_CACHE_PATH = config_json["build_cache_path"]
+
+# for videos, only the first and last chunk of this size gets hashed (together with the size and modification time),
+#   hashing the full 4K videos on every run would cost almost as much as decoding them
+VIDEO_HASH_CHUNK_SIZE = 1 << 20
+
+"""
+====================================================================================================
+
+    Build cache used by main.py to skip the work whose inputs did not change since the last run
+      - BuildCache
+      - fingerprint helpers (fileFingerprint, videoFingerprint, codeFingerprint, configFingerprint)
+
+====================================================================================================
+"""
+
+class BuildCache:
+    """
+    Build Cache keeps track of the fingerprint of the inputs that every output of the pipeline was built from
+
+    An output is identified by the stage that builds it and a key (e.g. the path of the output),
+      and its fingerprint is a json serializable value (usually a dictionary of the fingerprints of the inputs).
+      If an output still exists and its fingerprint did not change since it was built, the stage can reuse it.
+
+    Parameters:
+        cache_path - string, path to the json where the fingerprints are saved
+            default = BUILD_CACHE_PATH in the config file
+        force - bool, default = False
+            if True, nothing is considered up to date, so everything gets rebuilt (and recorded again)
+    """
+    def __init__(self, cache_path=BUILD_CACHE_PATH, force=False):
+        self.cache_path = cache_path
+        self.force = force
+
+        if os.path.exists(cache_path):
+            with open(cache_path, "r") as f:
+                self.fingerprints = json.load(f)
+        else:
+            self.fingerprints = {}
+
+        # stage -> {"reused": int, "rebuilt": int}, for printSummary
+        self.summary = {}
+
+
+    """
+    Return True if the output {output_key} of {stage} can be reused,
+      i.e. it was built from inputs with the same {fingerprint} and all the {output_paths} still exist
+
+    Parameters:
+        stage - string, name of the stage
+        output_key - string, identifier of the output within the stage
+        fingerprint - json serializable, fingerprint of the inputs of the output
+        output_paths - list of string, files that the output consists of
+    """
+    def isUpToDate(self, stage, output_key, fingerprint, output_paths):
+        stage_summary = self.summary.setdefault(stage, {"reused": 0, "rebuilt": 0})
+
+        up_to_date = (not self.force
+                        and fingerprint != None
+                        and self.fingerprints.get(stage, {}).get(output_key) == fingerprint
+                        and all(os.path.exists(p) for p in output_paths))
+
+        if up_to_date:
+            stage_summary["reused"] += 1
+        else:
+            stage_summary["rebuilt"] += 1
+
+        return up_to_date
+
+
+    """
+    Record that the output {output_key} of {stage} got built from inputs with {fingerprint}
+    """
+    def record(self, stage, output_key, fingerprint):
+        self.fingerprints.setdefault(stage, {})[output_key] = fingerprint
+
+
+    """
+    Save the fingerprints to the cache json
+    """
+    def save(self):
+        cache_dir = os.path.dirname(self.cache_path)
+        if cache_dir != "":
+            os.makedirs(cache_dir, exist_ok=True)
+
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.fingerprints, f)
+
+        os.replace(tmp_path, self.cache_path)
+
+
+    """
+    Print how many outputs got reused and rebuilt for every stage
+    """
+    def printSummary(self):
+        print("------------ Build Cache Summary ------------")
+        if self.force:
+            print("     (forced rebuild)")
+
+        for stage in self.summary:
+            print(f"{stage}: {self.summary[stage]['reused']} reused, {self.summary[stage]['rebuilt']} rebuilt")
+
+
+"""
+====================================================================================================
+
+    Fingerprint helpers
+
+====================================================================================================
+"""
+
+"""
+Return the sha256 of the content of the file at {file_path}
+"""
+def fileFingerprint(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(VIDEO_HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+"""
+Return the fingerprint of the video at {video_path}:
+  its size, its modification time and the sha256 of its first and last VIDEO_HASH_CHUNK_SIZE bytes
+"""
+def videoFingerprint(video_path):
+    video_stat = os.stat(video_path)
+
+    sha256 = hashlib.sha256()
+    with open(video_path, "rb") as f:
+        sha256.update(f.read(VIDEO_HASH_CHUNK_SIZE))
+        if video_stat.st_size > VIDEO_HASH_CHUNK_SIZE:
+            f.seek(max(VIDEO_HASH_CHUNK_SIZE, video_stat.st_size - VIDEO_HASH_CHUNK_SIZE))
+            sha256.update(f.read(VIDEO_HASH_CHUNK_SIZE))
+
+    return {"size": video_stat.st_size, "mtime": video_stat.st_mtime_ns, "sha256": sha256.hexdigest()}
+
+
+"""
+Return the fingerprint of the code version: the sha256 of the given source files together
+
+Parameters:
+    source_paths - list of string, paths to the python files the output depends on
+"""
+def codeFingerprint(source_paths):
+    sha256 = hashlib.sha256()
+    for source_path in source_paths:
+        sha256.update(fileFingerprint(source_path).encode())
+
+    return sha256.hexdigest()
+
+
+"""
+Return the sha256 of the config file
+"""
+def configFingerprint():
+    return fileFingerprint("./config.json")
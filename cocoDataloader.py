@@ -2,9 +2,20 @@ import os
 import torch
 import torch.utils.data
 from PIL import Image
-from pycocotools.coco import COCO
+import numpy as np
 import json
 import random
+from collections import OrderedDict
+import io
+from videoFrameReader import VideoFrameReader
+from frameShard import FrameShardReader, getFrameShardPath
+from annotationIndex import AnnotationIndex, loadAnnotationIndex
+from frameCache import SharedFrameCache, getFrameCacheSlotSize
+from cocoIdGenerator import decodeImageId
+
+
+# names of the datasets in a split manifest
+SPLIT_NAMES = ["train", "validation", "test"]
 
 
 """
@@ -22,6 +33,8 @@ Create the train, valididation, test data loader individually
 Waring:
     for train, validation, test split, we are randomizing then splitting the available video filenames
         (if there are two annotations for the same video, both annotations will belong to the same set)
+    give a seed to get the same split every time, 
+        and a split manifest path to save the split and load it again in the next runs (see create_split_manifest)
 
 Parameter:
     image_dir_path - string, path to the directory that contain all the image/frames used by the overall COCO annotation
@@ -33,109 +46,301 @@ Parameter:
                                         the mapping between video filenames and file ids (used by the ID Generator)
     train_validation_test_split - tuple, (train_percentage, validation_percentage)
         the test percentage is implicitly represented as: 1 - train_percentage - validation_percentage
+    video_dir_path - string, default = None
+        if given, the frames are decoded straight from the videos in this directory (see CustomVideoCocoDataset)
+            instead of being read from image_dir_path, so the videos do not need to be converted to frames first
+    downscale_factor - int, default = 1
+        if larger than 1, the frames are loaded with width and height divided by downscale_factor,
+            and the bounding boxes are scaled to match (see CustomCocoDataset)
+    frame_shards - bool, default = False
+        if True, the frames are read from the frame shards in image_dir_path (see CustomShardCocoDataset)
+            instead of one jpg file per frame
+    box_format - string, default = "xyxy"
+        format of the bounding boxes in the targets, "xyxy" ([xmin, ymin, xmax, ymax]) or "xywh" ([xmin, ymin, width, height])
+    num_workers, pin_memory, persistent_workers, prefetch_factor - DataLoader settings, see create_dataloader
+    frame_cache_bytes - int, default = 0
+        if larger than 0, the validation and the test dataset each get a SharedFrameCache with this budget (in bytes),
+            so their frames are only decoded in the first epoch (as far as they fit)
+    target_size - tuple, default = None
+        (width, height), if given, the extracted frames are decoded at a reduced resolution that is still at least this size
+            (see CustomCocoDataset), not used when the frames are decoded from the videos
+    seed - int, default = None
+        seed of the shuffle of the videos before splitting them, None shuffles with the global random state (random.shuffle)
+    split_manifest_path - string, default = None
+        (include json filename), if given, the split is saved there, and loaded from there in the next runs 
+            as long as the merged COCO annotation, train_validation_test_split and seed are the same
+    bucket_batches - bool, default = False
+        if True, the batches are made of frames with similar number of annotations and the same size (see BucketBatchSampler)
+    clip_length - int, default = None
+        if given, the items of the dataloaders are clips of clip_length consecutive frames of the same video
+            instead of single frames (see CustomClipDataset), e.g. for tracking
+    clip_stride - int, default = 1, only used with clip_length, number of frames between the first frames of two clips
 """
 def create_train_validation_test_loader(image_dir_path, merged_coco_ann_path, batch_size, transform_fn, 
-                                        video_file_id_map_path, train_validation_test_split):
+                                        video_file_id_map_path, train_validation_test_split, video_dir_path=None, downscale_factor=1, 
+                                        frame_shards=False, box_format="xyxy", 
+                                        num_workers=0, pin_memory=False, persistent_workers=False, prefetch_factor=None, 
+                                        frame_cache_bytes=0, target_size=None, seed=None, split_manifest_path=None, 
+                                        bucket_batches=False, clip_length=None, clip_stride=1):
+    if bucket_batches and clip_length != None:
+        raise ValueError("bucket_batches buckets single frames, it cannot be used with clip_length")
+
+    # one annotation index for the whole merged coco, every dataset is a view of its own images of it
+    annotation_index = loadAnnotationIndex(merged_coco_ann_path)
+
+    split_manifest = None
+    if split_manifest_path != None:
+        split_manifest = load_split_manifest(split_manifest_path, merged_coco_ann_path, train_validation_test_split, seed)
+
+    if split_manifest == None:
+        split_manifest = create_split_manifest(merged_coco_ann_path, annotation_index, video_file_id_map_path, 
+                                                train_validation_test_split, seed)
+        if split_manifest_path != None:
+            save_split_manifest(split_manifest, split_manifest_path)
+
+    train_dataset_key, valid_dataset_key, test_dataset_key = (split_manifest["image_ids"][split] for split in SPLIT_NAMES)
+
+    if video_dir_path != None:
+        train_dataset = CustomVideoCocoDataset(video_dir_path, annotation_index, sorted(train_dataset_key), transform_fn, downscale_factor, box_format=box_format)
+        valid_dataset = CustomVideoCocoDataset(video_dir_path, annotation_index, sorted(valid_dataset_key), transform_fn, downscale_factor, box_format=box_format)
+        test_dataset = CustomVideoCocoDataset(video_dir_path, annotation_index, sorted(test_dataset_key), transform_fn, downscale_factor, box_format=box_format)
+    elif frame_shards:
+        train_dataset = CustomShardCocoDataset(image_dir_path, annotation_index, sorted(train_dataset_key), transform_fn, downscale_factor, box_format=box_format, target_size=target_size)
+        valid_dataset = CustomShardCocoDataset(image_dir_path, annotation_index, sorted(valid_dataset_key), transform_fn, downscale_factor, box_format=box_format, target_size=target_size)
+        test_dataset = CustomShardCocoDataset(image_dir_path, annotation_index, sorted(test_dataset_key), transform_fn, downscale_factor, box_format=box_format, target_size=target_size)
+    else:
+        train_dataset = CustomCocoDataset(image_dir_path, annotation_index, sorted(train_dataset_key), transform_fn, downscale_factor, box_format=box_format, target_size=target_size)
+        valid_dataset = CustomCocoDataset(image_dir_path, annotation_index, sorted(valid_dataset_key), transform_fn, downscale_factor, box_format=box_format, target_size=target_size)
+        test_dataset = CustomCocoDataset(image_dir_path, annotation_index, sorted(test_dataset_key), transform_fn, downscale_factor, box_format=box_format, target_size=target_size)
+
+    if frame_cache_bytes > 0:
+        # the frames decoded from the videos are not decoded in draft mode
+        slot_size = getFrameCacheSlotSize(annotation_index, downscale_factor, target_size if video_dir_path == None else None)
+        valid_dataset.frame_cache = SharedFrameCache(frame_cache_bytes, slot_size)
+        test_dataset.frame_cache = SharedFrameCache(frame_cache_bytes, slot_size)
+
+    if clip_length != None:
+        train_dataset = CustomClipDataset(train_dataset, clip_length, clip_stride)
+        valid_dataset = CustomClipDataset(valid_dataset, clip_length, clip_stride)
+        test_dataset = CustomClipDataset(test_dataset, clip_length, clip_stride)
+
+    dataloader_settings = {
+                            "num_workers": num_workers, 
+                            "pin_memory": pin_memory, 
+                            "persistent_workers": persistent_workers, 
+                            "prefetch_factor": prefetch_factor,
+                            "bucket_batches": bucket_batches,
+                            "seed": seed,
+                          }
+
+    return  (create_dataloader(train_dataset, batch_size, **dataloader_settings), 
+                create_dataloader(valid_dataset, batch_size, **dataloader_settings), 
+                create_dataloader(test_dataset, batch_size, **dataloader_settings))
+
+
+"""
+====================================================================================================
+
+    Helper functions
+
+====================================================================================================
+"""
+
+"""
+Split the videos into the train, validation and test dataset, and identify the images of every dataset
+
+Parameters:
+    merged_coco_ann_path - string, (include json filename), path to overall COCO annotation json
+    annotation_index - AnnotationIndex object, the annotation index of the overall COCO annotation
+    video_file_id_map_path, train_validation_test_split, seed - see create_train_validation_test_loader
+
+Return:
+    split manifest, dictionary with
+        "source" - the size and modification time of the merged COCO annotation
+        "split" - train_validation_test_split
+        "seed" - seed
+        "videos" - dictionary, for every dataset ("train", "validation", "test"), the list of its video filenames
+        "image_ids" - dictionary, for every dataset, the list of its image ids
+"""
+def create_split_manifest(merged_coco_ann_path, annotation_index, video_file_id_map_path, train_validation_test_split, seed=None):
     with open(video_file_id_map_path, "r") as f:
-        video_filename_list = json.load(f)["filenames"]       # list of video names (without .mp4)
+        video_file_id_map = json.load(f)
+    video_filename_list = video_file_id_map["filenames"]       # list of video names (without .mp4)
 
     train_pct, valid_pct = train_validation_test_split
     train_idx = int(len(video_filename_list) * train_pct)
     valid_idx = int(len(video_filename_list) * valid_pct)
 
     # shuffle the videos then split them
-    random.shuffle(video_filename_list)
+    #   without a seed, the global random state is used, so a random.seed(...) of the caller still makes the split reproducible
+    if seed == None:
+        random.shuffle(video_filename_list)
+    else:
+        random.Random(seed).shuffle(video_filename_list)
 
     train_video_filenames = video_filename_list[:train_idx]
     valid_video_filenames = video_filename_list[train_idx : train_idx + valid_idx]
     test_video_filenames = video_filename_list[train_idx + valid_idx:]
 
-    coco = COCO(merged_coco_ann_path)
+    # identify the keys in the annotation index that belong to the individual dataset
+    dataset_keys = filter_keys(train_video_filenames, valid_video_filenames, test_video_filenames, 
+                                annotation_index, video_file_id_map["id_map"])
 
-    # identify the keys in coco.imgs that belong to the individual dataset
-    train_dataset_key, valid_dataset_key, test_dataset_key = filter_keys(train_video_filenames, valid_video_filenames, test_video_filenames, coco)
+    coco_stat = os.stat(merged_coco_ann_path)
+    return {
+            "source": {"size": coco_stat.st_size, "mtime": coco_stat.st_mtime_ns},
+            "split": list(train_validation_test_split),
+            "seed": seed,
+            "videos": dict(zip(SPLIT_NAMES, [train_video_filenames, valid_video_filenames, test_video_filenames])),
+            "image_ids": dict(zip(SPLIT_NAMES, dataset_keys)),
+           }
 
-    train_dataset = CustomCocoDataset(image_dir_path, merged_coco_ann_path, sorted(train_dataset_key), transform_fn)
-    valid_dataset = CustomCocoDataset(image_dir_path, merged_coco_ann_path, sorted(valid_dataset_key), transform_fn)
-    test_dataset = CustomCocoDataset(image_dir_path, merged_coco_ann_path, sorted(test_dataset_key), transform_fn)
 
-    return  create_dataloader(train_dataset, batch_size), create_dataloader(valid_dataset, batch_size), create_dataloader(test_dataset, batch_size)
+"""
+Return the split manifest saved at {split_manifest_path} (see create_split_manifest),
+    None if it does not exist, or it was not made for the current merged COCO annotation with the same split and seed
+"""
+def load_split_manifest(split_manifest_path, merged_coco_ann_path, train_validation_test_split, seed=None):
+    if not os.path.exists(split_manifest_path):
+        return None
 
+    with open(split_manifest_path, "r") as f:
+        split_manifest = json.load(f)
 
-"""
-====================================================================================================
+    coco_stat = os.stat(merged_coco_ann_path)
+    if (split_manifest["source"] != {"size": coco_stat.st_size, "mtime": coco_stat.st_mtime_ns}
+            or split_manifest["split"] != list(train_validation_test_split)
+            or split_manifest["seed"] != seed):
+        print(f"WARNING: split manifest = {split_manifest_path} does not match, splitting again")
+        return None
 
-    Helper functions
+    return split_manifest
 
-====================================================================================================
+
+"""
+Save the {split_manifest} (see create_split_manifest) at {split_manifest_path}
 """
+def save_split_manifest(split_manifest, split_manifest_path):
+    tmp_path = f"{split_manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(split_manifest, f)
+
+    os.replace(tmp_path, split_manifest_path)
+
 
 """
 Given a Pytorch dataset and the batch size, create the corresponding dataloader
+
+Parameters:
+    dataset - Pytorch dataset
+    batch_size - int, batch size for the dataloader
+    num_workers - int, default = 0
+        number of worker processes that load the frames, 0 loads them in the training process
+    pin_memory - bool, default = False
+        if True, the batches are copied to page-locked memory, so the copy to the GPU is faster
+    persistent_workers - bool, default = False
+        only used with num_workers > 0, if True, the worker processes (and their open videos and shards) are kept between epochs
+    prefetch_factor - int, default = None
+        only used with num_workers > 0, number of batches every worker loads ahead, None keeps the DataLoader default
+    bucket_batches - bool, default = False
+        if True, the batches come from a BucketBatchSampler over the dataset (a CustomCocoDataset) instead of plain shuffling
+    seed - int, default = None, seed of the BucketBatchSampler
 """
-def create_dataloader(dataset, batch_size):
-    # collate_fn needs for batch
-    def collate_fn(batch):
-        return tuple(zip(*batch))
+def create_dataloader(dataset, batch_size, num_workers=0, pin_memory=False, persistent_workers=False, prefetch_factor=None, 
+                        bucket_batches=False, seed=None):
+    if bucket_batches:
+        batch_settings = {"batch_sampler": BucketBatchSampler(dataset, batch_size, seed=seed)}
+    else:
+        batch_settings = {"batch_size": batch_size, "shuffle": True}
+
+    worker_settings = {}
+    if num_workers > 0:
+        # the DataLoader does not accept these without worker processes
+        worker_settings["persistent_workers"] = persistent_workers
+        if prefetch_factor != None:
+            worker_settings["prefetch_factor"] = prefetch_factor
 
     # own DataLoader
     # solve the issue of 
     return torch.utils.data.DataLoader(dataset,
-                                        batch_size=batch_size,
-                                        shuffle=True,
-                                        num_workers=0,
-                                        collate_fn=collate_fn)
+                                        num_workers=num_workers,
+                                        pin_memory=pin_memory,
+                                        collate_fn=collate_fn,
+                                        **batch_settings,
+                                        **worker_settings)
+
+
+"""
+collate_fn needs for batch
+
+It is at module level, so it can be pickled for the DataLoader worker processes
+"""
+def collate_fn(batch):
+    return tuple(zip(*batch))
 
 
 """
 Filter and identify the image keys that belng to a particular dataaset
 
+The file id of every image is decoded from its image id (the leading digits, see CocoIdGenerator) when the annotation index
+    is compiled, and looked up in a table from file id to dataset, built from the video to file ids map,
+    so the frame filenames do not get parsed. 
+    The images whose id cannot be trusted to decode to their own file (e.g. remapped by the merge, see getDecodedFileIds)
+    and the images whose file id is not in the map for their video (e.g. from a stale coco json) fall back to the frame filename
+
 Parameters:
     train_video_filename_list - list of video filenames that belong to the training dataset
     valid_video_filename_list - list of video filenames that belong to the validation dataset
     test_video_filename_list - list of video filenames that belong to the testing dataset
-    coco - coco annotation object, the overall coco that contains all the data
+    annotation_index - AnnotationIndex object, the annotation index of the overall coco that contains all the data
+    video_file_id_map - dictionary, video filename -> list of file ids of the video 
+        (the "id_map" in the json generated by generatetVidToFileIdMap)
 
 Return:
     train_dataset_key, valid_dataset_key, test_dataset_key
-        3 lists of keys, each one specifying the key in coco.imags that belong to a dataset
+        3 lists of keys, each one specifying the image ids in the annotation index that belong to a dataset
             (the key essentially specifies that images belong to the dataset)
 """
-def filter_keys(train_video_filename_list, valid_video_filename_list, test_video_filename_list, coco):
-    train_dataset_key = []
-    valid_dataset_key = []
-    test_dataset_key = []
-
-    for key, value in coco.imgs.items():
-        img_id= value['id']
-
-        if coco.getAnnIds(imgIds=[img_id]) != []:
-            # get the video filename from the frame path
-            #   get rid of the _2 ending
-            video_filename_split = value['file_name'].split("_")
-                
-            if "_2" in value['file_name']:
-                video_filename_split = video_filename_split[:-2]
-            else:
-                video_filename_split = video_filename_split[:-1]
-            
-            # recombnie the splitted video filenames into one string
-            video_filename = video_filename_split[0]
-            for video_filename_chuck in video_filename_split[1:]:
-                video_filename += "_" + video_filename_chuck
-            
-            if video_filename in train_video_filename_list:
-                train_dataset_key.append(key)
-            elif video_filename in valid_video_filename_list:
-                valid_dataset_key.append(key)
-            elif video_filename in test_video_filename_list:
-                test_dataset_key.append(key)
-            else:
-                print(f"ERROR: filename = {value['file_name']} does not belong to any dataset")
+def filter_keys(train_video_filename_list, valid_video_filename_list, test_video_filename_list, annotation_index, video_file_id_map):
+    video_filename_lists = [train_video_filename_list, valid_video_filename_list, test_video_filename_list]
+
+    # file id -> dataset (0 = train, 1 = validation, 2 = test), -1 if the file id does not belong to any dataset
+    max_file_id = max([file_id for file_ids in video_file_id_map.values() for file_id in file_ids], default=0)
+    dataset_of_file_id = np.full(max_file_id + 1, -1, dtype=np.int64)
+    for dataset, video_filename_list in enumerate(video_filename_lists):
+        for video_filename in video_filename_list:
+            dataset_of_file_id[video_file_id_map.get(video_filename, [])] = dataset
+
+    image_ids = np.asarray(annotation_index.image_ids)
+    # -1 for the image ids that cannot be trusted to decode to the file of the image (e.g. remapped by the merge)
+    file_ids = np.asarray(annotation_index.file_ids)
+
+    # a file id is only used if the map has it for the video of the frames with it (e.g. not for a stale coco json)
+    for file_id in np.unique(file_ids[file_ids >= 0]).tolist():
+        video_filename, _ = get_video_frame(str(annotation_index.file_names[np.argmax(file_ids == file_id)]))
+        if file_id not in video_file_id_map.get(video_filename, []):
+            file_ids = np.where(file_ids == file_id, -1, file_ids)
+
+    datasets = np.full(len(image_ids), -1, dtype=np.int64)
+    known_file_id = (file_ids >= 0) & (file_ids <= max_file_id)
+    datasets[known_file_id] = dataset_of_file_id[file_ids[known_file_id]]
+
+    # fall back to the video filename of the frame for the images whose file id is not used
+    video_filename_datasets = {video_filename: dataset for dataset, video_filename_list in enumerate(video_filename_lists) 
+                                                            for video_filename in video_filename_list}
+    for position in np.flatnonzero(datasets == -1):
+        video_filename, _ = get_video_frame(str(annotation_index.file_names[position]))
+
+        if video_filename in video_filename_datasets:
+            datasets[position] = video_filename_datasets[video_filename]
         else:
-          print(f"WARNING: filename = {value['file_name']} does not have annotation")           
+            print(f"ERROR: filename = {annotation_index.file_names[position]} does not belong to any dataset")
 
-    return train_dataset_key, valid_dataset_key, test_dataset_key
+    has_ann = np.diff(annotation_index.ann_offsets) != 0
+    if not has_ann.all():
+        print(f"WARNING: {np.count_nonzero(~has_ann)} images do not have annotation, they are not used")
+
+    return tuple(image_ids[has_ann & (datasets == dataset)].tolist() for dataset in range(3))
 
 
 """
@@ -143,23 +348,59 @@ Note:
     Most of the code is taken from 
         https://medium.com/fullstackai/how-to-train-an-object-detector-with-your-own-coco-dataset-in-pytorch-319e7090da5
 
+The annotations are read from the columnar annotation index of the COCO annotation (see annotationIndex.py),
+    so the targets of an image are slices of memory mapped arrays instead of dictionaries of a COCO object
+
 Parameters:
     root - string, the path to the directory that contain all the images/frames for the COCO annotation
     annotation - string, (including the json filename), path to merged COCO annotation
+        its annotation index gets compiled next to it the first time (see loadAnnotationIndex)
+        or an AnnotationIndex object, to share one annotation index between datasets (e.g. the train, validation and test split)
     img_ids - list, list of keys that correspond to images that will get used in the dataset
         If it is not specified, we assume to be using all the images for this dataset
     transforms - function, image transformations
                     at least should have:  torchvision.transforms.Compose([torchvision.transforms.ToTensor()] 
+    downscale_factor - int, default = 1
+        if larger than 1, the frames are read from the downscale_{downscale_factor} directory inside root
+            (extracted by convertAllVideosToFrames with that downscale factor),
+            and the bounding boxes and areas are scaled to the size of the loaded frame
+    box_format - string, default = "xyxy"
+        format of the bounding boxes in the targets
+            "xyxy" - [xmin, ymin, xmax, ymax], what the torchvision detection models take
+            "xywh" - [xmin, ymin, width, height], the coco format
+
+    target_size - tuple, default = None
+        (width, height), if given, the jpg frames are decoded in draft mode: the jpg decoder scales the frame down by 1/2, 1/4 or 1/8
+            while decoding (the largest reduction that still keeps the frame at least target_size),
+            which is a lot cheaper than decoding the full frame and resizing it afterwards.
+            The bounding boxes and areas are scaled to the size of the decoded frame, like for downscale_factor
+
+The attribute frame_cache can be set to a SharedFrameCache (see frameCache.py), default = None,
+    then the decoded frames are kept in the cache, shared by all the DataLoader workers and kept between epochs
+    (e.g. for the validation and test frames, that are loaded every epoch without random transformations)
 """
 class CustomCocoDataset(torch.utils.data.Dataset):
-    def __init__(self, root, annotation, img_ids=None, transforms=None):
+    def __init__(self, root, annotation, img_ids=None, transforms=None, downscale_factor=1, box_format="xyxy", target_size=None):
         self.root = root
+        if downscale_factor > 1:
+            self.root = os.path.join(root, f"downscale_{downscale_factor}")
+        self.downscale_factor = downscale_factor
+        if box_format not in ["xyxy", "xywh"]:
+            raise ValueError(f"box_format = {box_format} is not supported, use \"xyxy\" or \"xywh\"")
+        self.box_format = box_format
+        self.target_size = target_size
         self.transforms = transforms
-        self.coco = COCO(annotation)
+        if isinstance(annotation, AnnotationIndex):
+            self.index = annotation
+        else:
+            self.index = loadAnnotationIndex(annotation)
         if img_ids == None:
-            self.ids = list(sorted(self.coco.imgs.keys()))
+            self.ids = self.index.image_ids.tolist()
         else:
             self.ids = img_ids
+        # position of every image of the dataset in the annotation index
+        self.positions = self.index.getImagePositions(self.ids)
+        self.frame_cache = None
 
     """
     Required member function
@@ -167,44 +408,43 @@ class CustomCocoDataset(torch.utils.data.Dataset):
     Given an index, return the image and the annotation at that index in the dataset
     """
     def __getitem__(self, index):
-        # Own coco file
-        coco = self.coco
+        # open the input image
+        img = self.load_cached_image(self.positions[index])
+
+        return self.make_item(index, img)
+
+    """
+    Given an index and its loaded input image, return the (transformed) image and the annotation at that index in the dataset
+    """
+    def make_item(self, index, img):
         # Image ID
         img_id = self.ids[index]
-        # List: get annotation id from coco
-        ann_ids = coco.getAnnIds(imgIds=img_id)
-        # Dictionary: target coco_annotation file for an image
-        coco_annotation = coco.loadAnns(ann_ids)
-        # path for input image
-        path = coco.loadImgs(img_id)[0]['file_name']
-        # open the input image
-        img = Image.open(os.path.join(self.root, path))
-
-        # number of objects in the image
-        num_objs = len(coco_annotation)
-
-        # Bounding boxes for objects
-        # In coco format, bbox = [xmin, ymin, width, height]
-        # In pytorch, the input should be [xmin, ymin, xmax, ymax]
-        boxes = []
-        for i in range(num_objs):
-            xmin = coco_annotation[i]['bbox'][0]
-            ymin = coco_annotation[i]['bbox'][1]
-            xmax = xmin + coco_annotation[i]['bbox'][2]
-            ymax = ymin + coco_annotation[i]['bbox'][3]
-            boxes.append([xmin, ymin, xmax, ymax])
-        boxes = torch.as_tensor(boxes, dtype=torch.float32)
-        # Labels
-        labels = torch.ones((num_objs,), dtype=torch.int64)
+        # position of the image in the annotation index
+        position = self.positions[index]
+        # the annotations of the image are the rows start to end of the annotation arrays
+        start, end = self.index.ann_offsets[position], self.index.ann_offsets[position + 1]
+
+        # the loaded image can be smaller than the image in the annotation (downscaled frames),
+        #   so the bounding boxes get scaled by the same ratio
+        scale_x = img.size[0] / self.index.widths[position]
+        scale_y = img.size[1] / self.index.heights[position]
+
+        # Bounding boxes for objects, precomputed in the annotation index in both formats
+        if self.box_format == "xyxy":
+            boxes = torch.from_numpy(np.array(self.index.boxes_xyxy[start:end]))
+        else:
+            boxes = torch.from_numpy(np.array(self.index.boxes[start:end]))
+        # Size of bbox (Rectangular)
+        areas = torch.from_numpy(np.array(self.index.areas[start:end]))
+        if scale_x != 1 or scale_y != 1:
+            boxes *= torch.tensor([scale_x, scale_y, scale_x, scale_y], dtype=torch.float32)
+            areas *= scale_x * scale_y
+        # Labels, the category id (1 = shark, 2 = human)
+        labels = torch.from_numpy(np.array(self.index.category_ids[start:end]))
         # Tensorise img_id
         img_id = torch.tensor([img_id])
-        # Size of bbox (Rectangular)
-        areas = []
-        for i in range(num_objs):
-            areas.append(coco_annotation[i]['area'])
-        areas = torch.as_tensor(areas, dtype=torch.float32)
         # Iscrowd
-        iscrowd = torch.zeros((num_objs,), dtype=torch.int64)
+        iscrowd = torch.from_numpy(np.array(self.index.iscrowd[start:end]))
 
         # Annotation is in dictionary format
         my_annotation = {}
@@ -221,3 +461,282 @@ class CustomCocoDataset(torch.utils.data.Dataset):
 
     def __len__(self):
         return len(self.ids)
+
+    """
+    Given the positions of images in the annotation index (e.g. the frames of a clip, see CustomClipDataset), 
+        return the list of input images
+    """
+    def load_cached_images(self, positions):
+        return [self.load_cached_image(position) for position in positions]
+
+    """
+    Given the position of an image in the annotation index, return the input image from the frame cache,
+        or load it (and put it in the frame cache) if it is not cached
+    """
+    def load_cached_image(self, position):
+        if self.frame_cache == None:
+            return self.load_image(position)
+
+        key = int(position)
+        img = self.frame_cache.get(key)
+        if img == None:
+            img = self.load_image(position)
+            self.frame_cache.put(key, img)
+
+        return img
+
+    """
+    Given the position of an image in the annotation index, return the input image
+    """
+    def load_image(self, position):
+        # path for input image
+        path = self.index.file_names[position]
+        return self.open_image(os.path.join(self.root, path))
+
+    """
+    Open the jpg frame {fp} (path or file object), in draft mode if the dataset has a target size
+    """
+    def open_image(self, fp):
+        img = Image.open(fp)
+        if self.target_size != None:
+            # only changes the scale the jpg gets decoded at, the frame is not decoded yet
+            img.draft("RGB", tuple(self.target_size))
+        return img
+
+
+"""
+Same as CustomCocoDataset, but the frames are decoded straight from the videos instead of opening the extracted frames,
+    so the videos do not need to be converted to frames first
+
+The frame filename in the COCO annotation, {video_filename}_{frame number}.jpg (with _2 before the frame number
+    for the second annotation of a video), tells which video and which frame (in units of 0.1 sec) to decode
+
+The last {max_open_videos} videos read stay open (see VideoFrameReader), so requesting the frames of a video in
+    increasing order (e.g. without shuffling, or the frames of a clip) reuses one decoder instead of seeking for every frame
+
+Parameters:
+    video_dir - string, the path to the directory that contain all the videos (.mp4)
+    annotation, img_ids, transforms, box_format - same as CustomCocoDataset
+    downscale_factor - int, default = 1
+        if larger than 1, the frames are scaled down while decoding (the bounding boxes are scaled like in CustomCocoDataset)
+    max_open_videos - int, default = 4, number of videos kept open (per DataLoader worker)
+"""
+class CustomVideoCocoDataset(CustomCocoDataset):
+    def __init__(self, video_dir, annotation, img_ids=None, transforms=None, downscale_factor=1, box_format="xyxy", max_open_videos=4):
+        super().__init__(video_dir, annotation, img_ids, transforms, box_format=box_format)
+        self.downscale_factor = downscale_factor
+        self.max_open_videos = max_open_videos
+        # video path -> VideoFrameReader, the most recently used one at the end
+        self.readers = OrderedDict()
+
+    def load_image(self, position):
+        video_filename, frame_number = get_video_frame(self.index.file_names[position])
+        video_path = os.path.join(self.root, video_filename + ".mp4")
+
+        if video_path in self.readers:
+            self.readers.move_to_end(video_path)
+        else:
+            self.readers[video_path] = VideoFrameReader(video_path, int(self.index.widths[position]), int(self.index.heights[position]), 
+                                                        downscale_factor=self.downscale_factor)
+
+            if len(self.readers) > self.max_open_videos:
+                _, reader = self.readers.popitem(last=False)
+                reader.close()
+
+        return self.readers[video_path].readFrame(frame_number)
+
+    """
+    The open videos (ffmpeg processes) cannot be pickled, e.g. when the dataset gets sent to the DataLoader workers,
+        every worker opens its own
+    """
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["readers"] = OrderedDict()
+        return state
+
+    def __del__(self):
+        for reader in self.readers.values():
+            reader.close()
+
+
+"""
+Same as CustomCocoDataset, but the frames are read from the frame shards written by convertAllVideosToFrames with shard=True
+    (see frameShard.py), instead of opening one jpg file per frame
+
+The shard of a video is opened the first time one of its frames is read, and stays open,
+    the open shards are not pickled, so every DataLoader worker opens its own
+
+Parameters:
+    root - string, the path to the directory that contain the frame shards
+    annotation, img_ids, transforms, downscale_factor, box_format, target_size - same as CustomCocoDataset
+"""
+class CustomShardCocoDataset(CustomCocoDataset):
+    def __init__(self, root, annotation, img_ids=None, transforms=None, downscale_factor=1, box_format="xyxy", target_size=None):
+        super().__init__(root, annotation, img_ids, transforms, downscale_factor, box_format, target_size)
+        # shard path -> FrameShardReader
+        self.shards = {}
+
+    def load_image(self, position):
+        frame_filename = str(self.index.file_names[position])
+
+        video_filename, _ = get_video_frame(frame_filename)
+        shard_path = getFrameShardPath(self.root, video_filename)
+
+        if shard_path not in self.shards:
+            self.shards[shard_path] = FrameShardReader(shard_path)
+
+        return self.open_image(io.BytesIO(self.shards[shard_path].readFrame(frame_filename)))
+
+    """
+    Frames of the same video are next to each other in its shard, so they are read with one read (see FrameShardReader.readFrames)
+    """
+    def load_cached_images(self, positions):
+        frame_filenames = [str(self.index.file_names[position]) for position in positions]
+        video_filenames = set(get_video_frame(frame_filename)[0] for frame_filename in frame_filenames)
+
+        if self.frame_cache != None or len(video_filenames) != 1:
+            return super().load_cached_images(positions)
+
+        shard_path = getFrameShardPath(self.root, video_filenames.pop())
+        if shard_path not in self.shards:
+            self.shards[shard_path] = FrameShardReader(shard_path)
+
+        return [self.open_image(io.BytesIO(frame_bytes)) for frame_bytes in self.shards[shard_path].readFrames(frame_filenames)]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shards"] = {}
+        return state
+
+    def __del__(self):
+        for shard in self.shards.values():
+            shard.close()
+
+
+"""
+Dataset of clips: windows of {clip_length} consecutive annotated frames of the same video, from the frames of {dataset}, for tracking
+
+The frame order comes from the image ids (the file id and the frame number, see CocoIdGenerator),
+    or from the frame filename for the images whose id cannot be trusted (e.g. remapped by the merge, see getDecodedFileIds),
+    a clip never spans two videos (annotations), and the frame numbers of neighbouring frames in a clip differ by at most {max_gap}.
+    A new clip starts every {stride} frames.
+    The frames of a clip are loaded in increasing order with load_cached_images, so they are read with one seek
+    (one read from the shard for CustomShardCocoDataset, one seek of the open decoder for CustomVideoCocoDataset)
+
+Parameters:
+    dataset - CustomCocoDataset (or a subclass), the frames (and their targets)
+    clip_length - int, number of frames in a clip
+    stride - int, default = 1, number of frames between the first frames of two clips
+    max_gap - int, default = 1, the largest difference of the frame numbers (in units of 0.1 sec) of two neighbouring frames in a clip
+
+Return (of __getitem__):
+    images, annotations - 2 lists with the image and the annotation (see CustomCocoDataset) of every frame of the clip
+"""
+class CustomClipDataset(torch.utils.data.Dataset):
+    def __init__(self, dataset, clip_length, stride=1, max_gap=1):
+        self.dataset = dataset
+        self.clip_length = clip_length
+
+        image_ids = np.asarray(dataset.ids, dtype=np.int64)
+        file_ids = np.asarray(dataset.index.file_ids)[dataset.positions]
+        _, frame_numbers = decodeImageId(image_ids)
+
+        # the frames with untrusted ids are grouped by their coco json (the frame filename without the frame number) instead,
+        #   under file ids after all the others
+        untrusted = np.flatnonzero(file_ids == -1)
+        if len(untrusted) > 0:
+            stems, untrusted_frame_numbers = zip(*(os.path.splitext(str(dataset.index.file_names[dataset.positions[i]]))[0].rsplit("_", 1) 
+                                                    for i in untrusted))
+            _, stem_numbers = np.unique(stems, return_inverse=True)
+            file_ids[untrusted] = file_ids.max() + 1 + stem_numbers
+            frame_numbers[untrusted] = [int(frame_number) for frame_number in untrusted_frame_numbers]
+
+        order = np.lexsort((frame_numbers, file_ids))
+        file_ids, frame_numbers = file_ids[order], frame_numbers[order]
+
+        # a new run of frames starts at every new file or at every gap larger than max_gap
+        run_starts = np.flatnonzero(np.concatenate([[True], (np.diff(file_ids) != 0) | (np.diff(frame_numbers) > max_gap)]))
+        run_ends = np.append(run_starts[1:], len(order))
+
+        # dataset indices of the first frame of every clip
+        clip_starts = [np.arange(run_start, run_end - clip_length + 1, stride) for run_start, run_end in zip(run_starts, run_ends)]
+        clip_starts = np.concatenate(clip_starts) if clip_starts != [] else np.array([], dtype=np.int64)
+
+        # dataset indices of the frames of every clip, number of clips x clip_length
+        self.clips = order[clip_starts[:, None] + np.arange(clip_length)]
+
+    def __getitem__(self, index):
+        indices = self.clips[index]
+        imgs = self.dataset.load_cached_images(self.dataset.positions[indices])
+
+        items = [self.dataset.make_item(i, img) for i, img in zip(indices, imgs)]
+        return [img for img, _ in items], [ann for _, ann in items]
+
+    def __len__(self):
+        return len(self.clips)
+
+    """
+    The frame cache of the frames (see CustomCocoDataset)
+    """
+    @property
+    def frame_cache(self):
+        return self.dataset.frame_cache
+
+
+"""
+Batch sampler that puts frames with a similar number of annotations and the same size in the same batch,
+    so the targets in a batch have similar sizes and the steps take a similar time
+
+The frames are grouped into buckets by their size (width, height) and their number of annotations,
+    counted in the ranges given by count_boundaries (with the default: 0, 1, 2-3, 4-7, 8-15, 16 or more),
+    from the statistics in the annotation index, nothing gets loaded.
+    Every epoch, the frames are shuffled within their bucket, cut into batches, and the batches of all buckets are shuffled
+
+Parameters:
+    dataset - CustomCocoDataset (or a subclass)
+    batch_size - int, maximum number of frames in a batch (the last batch of a bucket can be smaller)
+    count_boundaries - list of int, default = [1, 2, 4, 8, 16], the smallest number of annotations of every bucket after the first
+    seed - int, default = None, seed of the shuffling, None gives a different order every time
+"""
+class BucketBatchSampler(torch.utils.data.Sampler):
+    def __init__(self, dataset, batch_size, count_boundaries=[1, 2, 4, 8, 16], seed=None):
+        self.batch_size = batch_size
+        self.rng = np.random.default_rng(seed)
+
+        positions = dataset.positions
+        num_anns = (dataset.index.ann_offsets[positions + 1] - dataset.index.ann_offsets[positions])
+        count_buckets = np.searchsorted(count_boundaries, num_anns, side="right")
+
+        bucket_keys = np.stack([count_buckets, dataset.index.widths[positions], dataset.index.heights[positions]], axis=1)
+        _, bucket_of_frame = np.unique(bucket_keys, axis=0, return_inverse=True)
+        bucket_of_frame = bucket_of_frame.reshape(-1)
+
+        # list of the dataset indices in every bucket
+        self.buckets = [np.flatnonzero(bucket_of_frame == bucket) for bucket in range(bucket_of_frame.max(initial=-1) + 1)]
+
+    def __iter__(self):
+        batches = []
+        for bucket in self.buckets:
+            shuffled = self.rng.permutation(bucket)
+            batches += [shuffled[i : i + self.batch_size].tolist() for i in range(0, len(shuffled), self.batch_size)]
+
+        for batch in self.rng.permutation(len(batches)):
+            yield batches[batch]
+
+    def __len__(self):
+        return sum((len(bucket) + self.batch_size - 1) // self.batch_size for bucket in self.buckets)
+
+
+"""
+Given a frame filename from the COCO annotation, return the video filename (without .mp4) and the frame number
+
+    e.g. "DJI_0386_00012.jpg" -> ("DJI_0386", 12), "20210121_SUPNexttoShark_2_00012.jpg" -> ("20210121_SUPNexttoShark", 12)
+"""
+def get_video_frame(frame_filename):
+    frame_name, frame_number = os.path.splitext(frame_filename)[0].rsplit("_", 1)
+
+    # get rid of the _2 ending of the second annotation of the video
+    if frame_name.endswith("_2"):
+        frame_name = frame_name[:-2]
+
+    return frame_name, int(frame_number)
@@ -0,0 +1,200 @@
+import numpy as np
+
+# default number of digits of every section of the ids (see CocoIdGenerator)
+DIGITS_FOR_FILE = 3
+DIGITS_FOR_FRAME = 5
+DIGITS_FOR_OBJ = 3
+
+"""
+====================================================================================================
+
+    Annotation id and image id generator for converting VIA annotations to Coco json
+      - CocoIdGenerator
+          used by via2CocoConverter to generate the ids of one VIA annotation
+      - decodeImageId, decodeAnnId
+          if you want the file id, the frame id (and the object id) back from an id,
+            e.g. to know which video and which frame an image of the merged coco json belongs to
+
+    The ids are built with integer arithmetic, so they work on ints as well as on numpy arrays of ids (all at once)
+      this module does not read the config file, so the dataloader can import it on its own
+
+====================================================================================================
+"""
+
+class CocoIdGenerator:
+    """
+    Coco Id Generator generates the correct annotation id and image id in the following format:
+
+    If digits_for_file=3, digits_for_frame=5, digits_for_obj=3,
+    then the id would be formatted as the following:
+        _ _ _ _ _ _ _ _ _ _ _
+
+    where if we break it down into sections:
+        _ _ _   _ _ _ _ _ _   _ _ _
+       {  1  } {     2     } {  3  }
+
+    and each section is semantically defined as
+        1 = the file id, unique for each VIA annotation
+        2 = the frame id, unique for each frame in the video (in units of 0.1 sec)
+        3 = the object id, unique for each identified object in a video
+
+    A section that does not fit in its digits would run into the section before it and give the id of another frame (or object),
+      so it raises a ValueError instead
+
+
+    Parameters:
+        file_id - id, the video id for this particular via annotation
+        digits_for_file - int, default = 3
+            For the file id in the generated annotation id and image id, it gets allocated {digits_for_file} digits
+        digits_for_frame - int, default = 5
+            For the frame id in the generated annotation id and image id, it gets allocated {digits_for_frame} digits
+        digits_for_obj - int, default = 3
+            For the object id in the  generated annotation id and image id, it gets allocated {digits_for_obj} digits
+    """
+    def __init__(self, file_id, digits_for_file=DIGITS_FOR_FILE, digits_for_frame=DIGITS_FOR_FRAME, digits_for_obj=DIGITS_FOR_OBJ):
+        checkDigits("file id", file_id, digits_for_file)
+
+        self.file_id = file_id
+        self.digits_for_file = digits_for_file
+        self.digits_for_frame = digits_for_frame
+        self.digits_for_obj = digits_for_obj
+
+
+    """
+    Before the image id gets converted to integer (will lose any leading 0s), the image id has the format:
+        _ ... _   _ _ ... _ _
+       {   1   } {     2     }
+
+    and each section is semantically defined as
+        1 = the file id, unique for each VIA annotation, has self.digits_for_file number of digits
+        2 = the frame id, unique for each frame in the video (in units of 0.1 sec), has self.digits_for_frame number of digits
+
+    Parameters:
+        curr_time_int - int, the current time stamp in unit in 0.1 second
+
+    Return:
+        image id as an interger (losing the leading 0s)
+    """
+    def generateImageId(self, curr_time_int):
+        checkDigits("frame id", curr_time_int, self.digits_for_frame)
+
+        return self.file_id * 10 ** self.digits_for_frame + curr_time_int
+
+
+    """
+    Before the annotation id gets converted to integer (will lose any leading 0s), the annotation id has the format:
+        _ ... _   _ _ ... _ _   _ ... _
+       {   1   } {     2     } {   3   }
+
+    and each section is semantically defined as
+        1 = the file id, unique for each VIA annotation, has self.digits_for_file number of digits
+        2 = the frame id, unique for each frame in the video (in units of 0.1 sec), has self.digits_for_frame number of digits
+        3 = the object id, unique for each identified object in a video, has self.digits_for_object number of digits
+
+    Parameters:
+        curr_time_int - int, the current time stamp in unit in 0.1 second
+        obj_id - int, unique identifier for the object that appears at a particular time stamp
+
+    Return:
+        annotation id as an interger (losing the leading 0s)
+    """
+    def generateAnnId(self, curr_time_int, obj_id):
+        checkDigits("object id", obj_id, self.digits_for_obj)
+
+        return self.generateImageId(curr_time_int) * 10 ** self.digits_for_obj + obj_id
+
+
+    """
+    Generate the image ids of all the time stamps in {curr_time_ints} at once
+
+    Parameters:
+        curr_time_ints - list or numpy array of int, the time stamps in unit in 0.1 second
+
+    Return:
+        numpy array of the image ids (int64)
+    """
+    def generateImageIds(self, curr_time_ints):
+        return self.generateImageId(np.asarray(curr_time_ints, dtype=np.int64))
+
+
+    """
+    Generate the annotation ids of all the (time stamp, object id) pairs in {curr_time_ints} and {obj_ids} at once
+
+    Parameters:
+        curr_time_ints - list or numpy array of int, the time stamps in unit in 0.1 second
+        obj_ids - list or numpy array of int, the object ids (same length as curr_time_ints)
+
+    Return:
+        numpy array of the annotation ids (int64)
+    """
+    def generateAnnIds(self, curr_time_ints, obj_ids):
+        return self.generateAnnId(np.asarray(curr_time_ints, dtype=np.int64), np.asarray(obj_ids, dtype=np.int64))
+
+
+    """
+    Return (file id, frame id) of the image id {image_id} (int or numpy array), see decodeImageId
+    """
+    def decodeImageId(self, image_id):
+        return decodeImageId(image_id, self.digits_for_frame)
+
+
+    """
+    Return (file id, frame id, object id) of the annotation id {ann_id} (int or numpy array), see decodeAnnId
+    """
+    def decodeAnnId(self, ann_id):
+        return decodeAnnId(ann_id, self.digits_for_frame, self.digits_for_obj)
+
+
+"""
+Return (file id, frame id) of the image id {image_id} generated by a CocoIdGenerator with {digits_for_frame}
+
+Parameters:
+    image_id - int, or numpy array of int (then the file ids and the frame ids are numpy arrays as well)
+    digits_for_frame - int, default = DIGITS_FOR_FRAME
+
+    e.g. 200123 -> (2, 123)
+"""
+def decodeImageId(image_id, digits_for_frame=DIGITS_FOR_FRAME):
+    return image_id // 10 ** digits_for_frame, image_id % 10 ** digits_for_frame
+
+
+"""
+Return (file id, frame id, object id) of the annotation id {ann_id} generated by a CocoIdGenerator
+    with {digits_for_frame} and {digits_for_obj}
+
+Parameters:
+    ann_id - int, or numpy array of int (then the ids are numpy arrays as well)
+    digits_for_frame - int, default = DIGITS_FOR_FRAME
+    digits_for_obj - int, default = DIGITS_FOR_OBJ
+
+    e.g. 200123004 -> (2, 123, 4)
+"""
+def decodeAnnId(ann_id, digits_for_frame=DIGITS_FOR_FRAME, digits_for_obj=DIGITS_FOR_OBJ):
+    file_id, frame_id = decodeImageId(ann_id // 10 ** digits_for_obj, digits_for_frame)
+    return file_id, frame_id, ann_id % 10 ** digits_for_obj
+
+
+"""
+====================================================================================================
+
+    Helper functions
+
+====================================================================================================
+"""
+
+"""
+Raise a ValueError if {value} (int or numpy array) is negative or does not fit in {digits} digits
+
+Parameters:
+    name - string, what the value is, for the error message
+"""
+def checkDigits(name, value, digits):
+    if isinstance(value, np.ndarray):
+        out_of_range = (value < 0) | (value >= 10 ** digits)
+        if not out_of_range.any():
+            return
+        value = value[out_of_range][0]
+    elif 0 <= value < 10 ** digits:
+        return
+
+    raise ValueError(f"{name} = {value} does not fit in {digits} digits")
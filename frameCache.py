@@ -0,0 +1,193 @@
+import os
+import tempfile
+import multiprocessing
+import numpy as np
+from PIL import Image
+
+# positions in SharedFrameCache.counters
+HITS, MISSES, EVICTIONS, CLOCK = range(4)
+
+
+class SharedFrameCache:
+    """
+    Shared Frame Cache keeps decoded frames (RGB) in memory, so a frame that is used every epoch
+      (e.g. the validation and test frames) only gets decoded once
+
+    The frames are kept in a memory mapped file (in /dev/shm if it exists, so it stays in memory),
+      split into slots of {slot_size} bytes, one frame per slot.
+      The bookkeeping (which frame is in which slot, when it was last used, the counters) is in shared memory,
+      so every DataLoader worker reads and fills the same cache, and the cache outlives the workers between epochs.
+      When the cache is full, the least recently used frame gets evicted
+
+    The cache can only be shared with processes started by the process that created it (e.g. the DataLoader workers)
+
+    Parameters:
+        budget_bytes - int, memory used for the cached frames
+        slot_size - int, number of bytes of the largest frame that can be cached (width * height * 3),
+            larger frames are not cached (see getFrameCacheSlotSize)
+        cache_dir - string, default = None
+            directory of the memory mapped file, /dev/shm if it exists, otherwise the temporary directory
+    """
+    def __init__(self, budget_bytes, slot_size, cache_dir=None):
+        self.num_slots = budget_bytes // slot_size
+        if self.num_slots == 0:
+            raise ValueError(f"frame cache budget = {budget_bytes} bytes is smaller than one frame = {slot_size} bytes")
+        self.slot_size = slot_size
+
+        if cache_dir == None:
+            cache_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+        fd, self.cache_path = tempfile.mkstemp(prefix="frame_cache_", dir=cache_dir)
+        os.ftruncate(fd, self.num_slots * slot_size)
+        os.close(fd)
+        self.owner_pid = os.getpid()
+
+        self.lock = multiprocessing.Lock()
+        # key of the frame in every slot, -1 if the slot is empty
+        self.slot_keys = multiprocessing.RawArray("q", [-1] * self.num_slots)
+        # width and height of the frame in every slot
+        self.slot_sizes = multiprocessing.RawArray("q", 2 * self.num_slots)
+        # value of the clock when the frame in every slot was last used, 0 if the slot is empty
+        self.slot_last_used = multiprocessing.RawArray("q", self.num_slots)
+        self.counters = multiprocessing.RawArray("q", 4)
+
+        self.mapArrays()
+
+
+    """
+    Return the frame with {key} as a RGB PIL image, None if it is not in the cache
+    """
+    def get(self, key):
+        with self.lock:
+            slots = np.flatnonzero(self.keys == key)
+            if len(slots) == 0:
+                self.counters[MISSES] += 1
+                return None
+
+            slot = slots[0]
+            self.counters[HITS] += 1
+            self.counters[CLOCK] += 1
+            self.last_used[slot] = self.counters[CLOCK]
+
+            width, height = self.sizes[slot]
+            # copied while holding the lock, so the slot cannot get evicted while it is read
+            start = slot * self.slot_size
+            frame_bytes = self.data[start : start + width * height * 3].tobytes()
+
+        return Image.frombytes("RGB", (int(width), int(height)), frame_bytes)
+
+
+    """
+    Put the frame {img} (PIL image) with {key} in the cache, evicting the least recently used frame if the cache is full
+
+    Parameters:
+        key - int, non negative, identifies the frame (e.g. the position of the image in the annotation index)
+        img - PIL image
+    """
+    def put(self, key, img):
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+
+        frame_bytes = img.tobytes()
+        if len(frame_bytes) > self.slot_size:
+            return
+
+        with self.lock:
+            # another worker might have put the same frame in the meantime
+            if (self.keys == key).any():
+                return
+
+            # empty slots were never used, so they come first
+            slot = int(np.argmin(self.last_used))
+            if self.keys[slot] != -1:
+                self.counters[EVICTIONS] += 1
+
+            start = slot * self.slot_size
+            self.data[start : start + len(frame_bytes)] = np.frombuffer(frame_bytes, dtype=np.uint8)
+
+            self.keys[slot] = key
+            self.sizes[slot] = img.size
+            self.counters[CLOCK] += 1
+            self.last_used[slot] = self.counters[CLOCK]
+
+
+    """
+    Return the counters of the cache, to size the cache for a machine
+
+    Return:
+        dictionary with
+            "hits", "misses", "evictions" - int, since the cache got created (summed over all the workers)
+            "hit_rate" - float, hits / (hits + misses)
+            "cached_frames" - int, number of frames in the cache
+            "capacity" - int, number of frames that fit in the cache
+    """
+    def getStats(self):
+        with self.lock:
+            hits, misses, evictions = self.counters[HITS], self.counters[MISSES], self.counters[EVICTIONS]
+            cached_frames = int((self.keys != -1).sum())
+
+        return {
+                "hits": hits,
+                "misses": misses,
+                "evictions": evictions,
+                "hit_rate": hits / (hits + misses) if hits + misses > 0 else 0.0,
+                "cached_frames": cached_frames,
+                "capacity": self.num_slots,
+               }
+
+
+    """
+    Remove the memory mapped file (only the process that created the cache does)
+    """
+    def close(self):
+        # (the cache might not have gotten that far in __init__)
+        if getattr(self, "owner_pid", None) == os.getpid() and os.path.exists(self.cache_path):
+            self.data = None
+            os.remove(self.cache_path)
+
+
+    """
+    Map the memory mapped file and the numpy views of the shared arrays in this process
+    """
+    def mapArrays(self):
+        self.data = np.memmap(self.cache_path, dtype=np.uint8, mode="r+", shape=(self.num_slots * self.slot_size,))
+        self.keys = np.frombuffer(self.slot_keys, dtype=np.int64)
+        self.sizes = np.frombuffer(self.slot_sizes, dtype=np.int64).reshape(self.num_slots, 2)
+        self.last_used = np.frombuffer(self.slot_last_used, dtype=np.int64)
+
+
+    """
+    The numpy views and the memory mapped file are not pickled, every worker maps them again
+    """
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for view in ["data", "keys", "sizes", "last_used"]:
+            del state[view]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.mapArrays()
+
+    def __del__(self):
+        self.close()
+
+
+"""
+Return the slot size for a SharedFrameCache that can hold every frame in {annotation_index} (AnnotationIndex object),
+    loaded with {downscale_factor} (and decoded in draft mode for {target_size}, see CustomCocoDataset)
+
+With target_size, every frame is decoded at the largest reduction (1/2, 1/4 or 1/8) that keeps it at least target_size,
+    the same rule as Image.draft, so the slots are sized for the decoded frames instead of the full frames
+"""
+def getFrameCacheSlotSize(annotation_index, downscale_factor=1, target_size=None):
+    widths = (annotation_index.widths // downscale_factor).astype(np.int64)
+    heights = (annotation_index.heights // downscale_factor).astype(np.int64)
+
+    if target_size != None:
+        scales = np.minimum(widths // target_size[0], heights // target_size[1])
+        draft_scales = np.select([scales >= 8, scales >= 4, scales >= 2], [8, 4, 2], default=1)
+        widths = -(-widths // draft_scales)
+        heights = -(-heights // draft_scales)
+
+    return int(np.max(widths * heights)) * 3
@@ -0,0 +1,242 @@
+import os
+import json
+
+# number of bytes read from the ffmpeg pipe at once
+READ_CHUNK_SIZE = 1 << 20
+
+"""
+====================================================================================================
+
+    Packed frame shards, instead of one jpg file per frame
+      - FrameShardWriter
+          used by video2FrameConverter to write the frames of a video straight from ffmpeg
+      - FrameShardReader
+          used by CustomShardCocoDataset to read the frames
+
+    A shard is one file with the jpg bytes of all the frames of a video, one after the other,
+      and an index json ({video filename}_index.json) with the offset table:
+        {"shard": shard filename, "frames": {frame filename: [offset, length]}}
+      the frame filenames are the same as the ones in the coco json
+      (the frames of the second annotation of a video point to the same bytes as the first one)
+
+====================================================================================================
+"""
+
+class FrameShardWriter:
+    """
+    Frame Shard Writer appends frames to a shard and keeps track of their offset
+
+    The shard is written to a temporary file, and only gets its name (together with its index) on close,
+      so a shard that exists is always complete
+
+    Parameters:
+        shard_path - string, path of the shard file
+    """
+    def __init__(self, shard_path):
+        self.shard_path = shard_path
+        self.tmp_path = f"{shard_path}.{os.getpid()}.tmp"
+
+        self.file = open(self.tmp_path, "wb")
+        self.offset = 0
+        # frame filename -> [offset, length]
+        self.frames = {}
+
+
+    """
+    Append the jpg bytes of one frame, under every filename in {frame_filenames}
+    """
+    def add(self, frame_filenames, frame_bytes):
+        self.file.write(frame_bytes)
+
+        for frame_filename in frame_filenames:
+            self.frames[frame_filename] = [self.offset, len(frame_bytes)]
+
+        self.offset += len(frame_bytes)
+
+
+    """
+    Finish the shard: rename it and write its index
+    """
+    def close(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.shard_path)
+
+        index_path = getShardIndexPath(self.shard_path)
+        tmp_index_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_index_path, "w") as f:
+            json.dump({"shard": os.path.basename(self.shard_path), "frames": self.frames}, f)
+
+        os.replace(tmp_index_path, index_path)
+
+
+    """
+    Throw away the unfinished shard
+    """
+    def discard(self):
+        self.file.close()
+        os.remove(self.tmp_path)
+
+
+class FrameShardReader:
+    """
+    Frame Shard Reader reads the jpg bytes of a frame from a shard
+
+    The shard file is opened on the first read and stays open,
+      and it is not pickled (e.g. every DataLoader worker opens its own)
+
+    Parameters:
+        shard_path - string, path of the shard file
+    """
+    def __init__(self, shard_path):
+        self.shard_path = shard_path
+
+        with open(getShardIndexPath(shard_path), "r") as f:
+            self.frames = json.load(f)["frames"]
+
+        self.file = None
+
+
+    """
+    Return the jpg bytes of the frame {frame_filename}
+    """
+    def readFrame(self, frame_filename):
+        if self.file == None:
+            self.file = open(self.shard_path, "rb")
+
+        offset, length = self.frames[frame_filename]
+        self.file.seek(offset)
+        return self.file.read(length)
+
+
+    """
+    Return the jpg bytes of the frames {frame_filenames}, as a list
+
+    If the frames are close together in the shard (e.g. the frames of a clip), they are read with one read
+    """
+    def readFrames(self, frame_filenames):
+        if self.file == None:
+            self.file = open(self.shard_path, "rb")
+
+        frame_spans = [self.frames[frame_filename] for frame_filename in frame_filenames]
+        span_start = min(offset for offset, _ in frame_spans)
+        span_end = max(offset + length for offset, length in frame_spans)
+
+        # the frames in between would be read for nothing
+        if span_end - span_start > 2 * sum(length for _, length in frame_spans):
+            return [self.readFrame(frame_filename) for frame_filename in frame_filenames]
+
+        self.file.seek(span_start)
+        span = self.file.read(span_end - span_start)
+        return [span[offset - span_start : offset - span_start + length] for offset, length in frame_spans]
+
+
+    """
+    Close the shard file, if it is open
+    """
+    def close(self):
+        if self.file != None:
+            self.file.close()
+            self.file = None
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["file"] = None
+        return state
+
+
+"""
+====================================================================================================
+
+    Helper functions
+
+====================================================================================================
+"""
+
+"""
+Return the path of the shard with the frames of the video {video_filename} (without .mp4) in {video_frame_dir}
+
+    e.g. ("./frames/", "DJI_0386") -> "./frames/DJI_0386.shard"
+"""
+def getFrameShardPath(video_frame_dir, video_filename):
+    return os.path.join(video_frame_dir, video_filename + ".shard")
+
+
+"""
+Return the path of the index json of the shard at {shard_path}
+
+    e.g. "./frames/DJI_0386.shard" -> "./frames/DJI_0386_index.json"
+"""
+def getShardIndexPath(shard_path):
+    return os.path.splitext(shard_path)[0] + "_index.json"
+
+
+"""
+Split a stream of jpgs written one after the other (e.g. by ffmpeg with -f image2pipe -c:v mjpeg),
+    and yield the bytes of every jpg
+
+The segments before the image data are skipped by their length,
+    and the image data ends at the first end of image marker (0xFFD9)
+    (inside the image data, 0xFF is always followed by 0x00 or a restart marker, so it cannot end early).
+    This assumes baseline jpgs (one scan), which is what ffmpeg's mjpeg encoder writes
+
+Parameter:
+    stream - binary file object to read from
+"""
+def iterJpegFrames(stream):
+    buffer = bytearray()
+
+    while True:
+        chunk = stream.read(READ_CHUNK_SIZE)
+        buffer += chunk
+
+        while len(buffer) >= 2:
+            if buffer[:2] != b"\xff\xd8":
+                raise ValueError("the stream does not continue with the start of a jpg")
+
+            end = findJpegEnd(buffer)
+            if end == None:
+                break
+
+            yield bytes(buffer[:end])
+            del buffer[:end]
+
+        if chunk == b"":
+            if len(buffer) != 0:
+                raise ValueError("the stream ends in the middle of a jpg")
+            return
+
+
+"""
+Return the position right after the end of the jpg that starts at the beginning of {buffer},
+    None if the jpg is not complete yet
+"""
+def findJpegEnd(buffer):
+    # right after the start of image marker
+    position = 2
+
+    while True:
+        if position + 4 > len(buffer):
+            return None
+
+        if buffer[position] != 0xFF:
+            raise ValueError(f"expected a jpg marker at byte {position}")
+
+        marker = buffer[position + 1]
+        if marker == 0xFF:
+            # fill byte before a marker
+            position += 1
+            continue
+
+        segment_length = (buffer[position + 2] << 8) | buffer[position + 3]
+        position += 2 + segment_length
+
+        # start of scan, the image data follows its header
+        if marker == 0xDA:
+            break
+
+    end = buffer.find(b"\xff\xd9", position)
+    if end == -1:
+        return None
+
+    return end + 2
@@ -2,22 +2,40 @@ import argparse
 
 from via2CocoConverter import convertAllViaToCoco, mergeAllCoco
 from video2FrameConverter import convertAllVideosToFrames, generatetVidToFileIdMap
+from buildCache import BuildCache
 
 """
 Overall main function to execute the entire workflow of our data processing pipeline
     Will save the log of any error in the log file directory specified in config.json
+
+    Every stage skips the outputs whose inputs (via jsons, videos, config.json and the code) did not change
+        since the last run, unless force is True (see buildCache.py)
 """
 def main(via_json_dir, video_dir, coco_json_dir, 
             merged_coco_json_path, 
             video_frame_dir, 
-            map_json_save_path):
+            map_json_save_path, 
+            num_workers=1, 
+            streaming_merge=False, 
+            append_merge=False, 
+            force=False, 
+            num_frame_jobs=1, 
+            threads_per_frame_job=0, 
+            annotated_frames_only=False, 
+            negative_fraction=0.0, 
+            downscale_factors=[], 
+            frame_shards=False):
+    build_cache = BuildCache(force=force)
+
     print("************************************************")
     print()
     print("     Converting ALL via jsons to coco jsons")
     print()
     print("************************************************\n")
 
-    convertAllViaToCoco(via_json_dir, video_dir, coco_json_dir)
+    # with annotated_frames_only, the coco jsons only have images for the frames that get extracted
+    convertAllViaToCoco(via_json_dir, video_dir, coco_json_dir, num_workers=num_workers, build_cache=build_cache, 
+                          annotated_images_only=annotated_frames_only, negative_fraction=negative_fraction)
 
     print("\n\n************************************************")
     print()
@@ -25,7 +43,7 @@ def main(via_json_dir, video_dir, coco_json_dir,
     print()
     print("************************************************\n")
 
-    mergeAllCoco(coco_json_dir, merged_coco_json_path)
+    mergeAllCoco(coco_json_dir, merged_coco_json_path, streaming=streaming_merge, append=append_merge, build_cache=build_cache)
 
     print("\n\n************************************************")
     print()
@@ -33,7 +51,12 @@ def main(via_json_dir, video_dir, coco_json_dir,
     print()
     print("************************************************\n")  
 
-    convertAllVideosToFrames(via_json_dir, video_dir, video_frame_dir) 
+    convertAllVideosToFrames(via_json_dir, video_dir, video_frame_dir, 
+                                num_jobs=num_frame_jobs, threads_per_job=threads_per_frame_job, build_cache=build_cache, 
+                                coco_json_dir=coco_json_dir if annotated_frames_only else None, 
+                                negative_fraction=negative_fraction, 
+                                downscale_factors=downscale_factors, 
+                                shard=frame_shards)
 
     print("\n\n************************************************")
     print()
@@ -41,7 +64,10 @@ def main(via_json_dir, video_dir, coco_json_dir,
     print()
     print("************************************************\n")  
 
-    generatetVidToFileIdMap(via_json_dir, map_json_save_path)
+    generatetVidToFileIdMap(via_json_dir, map_json_save_path, build_cache=build_cache)
+
+    print("\n\n")
+    build_cache.printSummary()
 
 
 if __name__ == '__main__':
@@ -63,11 +89,31 @@ if __name__ == '__main__':
     parser.add_argument("-m", "--mergedcoco", type=str, help="path (include filename w/ json) to save the merged coco json", required=True)
     parser.add_argument("-f", "--frame", type=str, help="path of where to save the video frames", required=True)
     parser.add_argument("-a", "--map", type=str, help="path (include filename w/ .json) to save the map from video filename to file id", required=True)
+    parser.add_argument("-w", "--workers", type=int, help="number of processes used to convert the via jsons to coco jsons", default=1)
+    parser.add_argument("-s", "--stream", action="store_true", help="write the merged coco json while merging, instead of building it in memory")
+    parser.add_argument("-u", "--append", action="store_true", help="only merge the coco jsons that are new or changed since the last merge")
+    parser.add_argument("-j", "--jobs", type=int, help="number of ffmpeg processes that convert videos to frames at the same time", default=1)
+    parser.add_argument("-t", "--threads", type=int, help="number of threads each ffmpeg process may use (0 lets ffmpeg decide)", default=0)
+    parser.add_argument("--annotated-only", action="store_true", help="only extract (and write coco images for) the frames that have annotations")
+    parser.add_argument("--negatives", type=float, help="with --annotated-only, fraction of the frames without annotations to extract as well", default=0.0)
+    parser.add_argument("--downscale", type=int, nargs="+", help="also save the frames downscaled by these factors (e.g. --downscale 2 4)", default=[])
+    parser.add_argument("--shard", action="store_true", help="write the frames of every video to one shard file instead of one jpg per frame")
+    parser.add_argument("--force", action="store_true", help="rebuild everything, even the outputs whose inputs did not change since the last run")
     
     args = parser.parse_args()
 
     main(via_json_dir = args.via, video_dir = args.video, coco_json_dir = args.coco, 
             merged_coco_json_path = args.mergedcoco, 
             video_frame_dir = args.frame, 
-            map_json_save_path = args.map)
+            map_json_save_path = args.map, 
+            num_workers = args.workers, 
+            streaming_merge = args.stream, 
+            append_merge = args.append, 
+            force = args.force, 
+            num_frame_jobs = args.jobs, 
+            threads_per_frame_job = args.threads, 
+            annotated_frames_only = args.annotated_only, 
+            negative_fraction = args.negatives, 
+            downscale_factors = args.downscale, 
+            frame_shards = args.shard)
 
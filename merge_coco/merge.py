@@ -1,6 +1,9 @@
 import sys
 import os
 import json
+import shutil
+import hashlib
+import traceback
 from tqdm import tqdm
 
 def dict_compare(d1, d2):
@@ -31,30 +34,14 @@ def testt(A):
     return Repeat(aa)
 
 
-def combine(tt1,tt2,output_file):
-    """ Combine two COCO annoatated files and save them into new file
-    :param tt1: 1st COCO file path
-    :param tt2: 2nd COCO file path
-    :param output_file: output file path
+def check_categories(categories1, categories2):
+    """ Assert that both category lists have the same categories, using only the name and id to compare
+    :param categories1: categories of the 1st COCO file
+    :param categories2: categories of the 2nd COCO file
     """
-    with open(tt1) as json_file:
-        d1 = json.load(json_file)
-    with open(tt2) as json_file:
-        d2 = json.load(json_file)
-    b1={}
-    for i,j in enumerate(d1['images']):
-        b1[d1['images'][i]['id']]=i
-
-    temp=[cc['file_name'] for cc in d1['images']]
-    temp2=[cc['file_name'] for cc in d2['images']]
-    for i in temp:
-        assert not(i in temp2), "Duplicate filenames detected between the two files! @" + i
-    
+    d1_categories_names = {c['name']: c['id'] for c in categories1}
+    d2_categories_names = {c['name']: c['id'] for c in categories2}
 
-    # Check if both files have the categories dict using only the value and id to compare
-    d1_categories_names = {c['name']: c['id'] for c in d1['categories']}
-    d2_categories_names = {c['name']: c['id'] for c in d2['categories']}
-    
     for c in d1_categories_names:
         # Check if the category name exists in the second file
         if c in d2_categories_names:
@@ -63,7 +50,7 @@ def combine(tt1,tt2,output_file):
                 assert False, 'Category name: {}, id: {} in file 1 and {} in file 2'.format(c, d1_categories_names[c], d2_categories_names[c])
         else:
             assert False, 'Category name: {} in file 1 does not exist in file 2'.format(c)
-    
+
     for c in d2_categories_names:
         if c in d1_categories_names:
             if d1_categories_names[c] != d2_categories_names[c]:
@@ -72,75 +59,86 @@ def combine(tt1,tt2,output_file):
             assert False, 'Category name: {} in file 2 does not exist in file 1'.format(c)
 
 
+def files_classes(d):
+    """ Map every image file name of a COCO file to the category ids of the annotations on that image
+    The annotations get indexed by image id first, so this is linear in the number of images and annotations
+    :param d: COCO file content (the loaded json dictionary)
+    :return: dictionary from image file name to the list of category ids (in annotation order)
+    """
+    categories_by_image_id = {}
+    for annotation in d['annotations']:
+        categories_by_image_id.setdefault(annotation['image_id'], []).append(annotation['category_id'])
+
+    files_check_classes = {}
+    for image in d['images']:
+        if image['id'] in categories_by_image_id:
+            files_check_classes.setdefault(image['file_name'], []).extend(categories_by_image_id[image['id']])
+    return files_check_classes
+
+
+def assert_same_classes(files_check_classes, files_check_classes_temp, stage):
+    """ Assert that no image file name got added or removed, and no image changed its list of classes
+    :param stage: "before" or "after", used in the error message
+    """
+    added, removed, modified, same = dict_compare(files_check_classes, files_check_classes_temp)
+    assert (len(added)==0 and len(removed)==0 and len(modified)==0),"filenames detected {} merging error: {} filenames added {} filenames removed {} filenames' classes modified {} filenames entries reserved".format(stage, len(added), len(removed), len(modified), len(same))
+
 
-    files_check_classes={}
+def combine(tt1,tt2,output_file):
+    """ Combine two COCO annoatated files and save them into new file
+    :param tt1: 1st COCO file path
+    :param tt2: 2nd COCO file path
+    :param output_file: output file path
+    """
+    with open(tt1) as json_file:
+        d1 = json.load(json_file)
+    with open(tt2) as json_file:
+        d2 = json.load(json_file)
+    b1={}
     for i,j in enumerate(d1['images']):
-        for ii,jj in enumerate(d1['annotations']):
-            if jj['image_id']==j['id']:
-                try:
-                    files_check_classes[j['file_name']].append(jj['category_id'])
-                except:
-                    files_check_classes[j['file_name']]=[jj['category_id']]
+        b1[j['id']]=i
 
-    for i,j in enumerate(d2['images']):
-        for ii,jj in enumerate(d2['annotations']):
-            if jj['image_id']==j['id']:
-                try:
-                    files_check_classes[j['file_name']].append(jj['category_id'])
-                except:
-                    files_check_classes[j['file_name']]=[jj['category_id']]
+    temp2=set(cc['file_name'] for cc in d2['images'])
+    for cc in d1['images']:
+        assert not(cc['file_name'] in temp2), "Duplicate filenames detected between the two files! @" + cc['file_name']
+
+    # Check if both files have the categories dict using only the value and id to compare
+    check_categories(d1['categories'], d2['categories'])
+
+    # file names never overlap between the two files (checked above), so the two dicts can simply be joined
+    files_check_classes=files_classes(d1)
+    files_check_classes.update(files_classes(d2))
 
     b2={}
+    max_b1=max(b1)
     for i,j in enumerate(d2['images']):
-        b2[d2['images'][i]['id']]=i+max(b1)+1
+        b2[j['id']]=i+max_b1+1
         
     #Reset File 1 and 2 images ids
     for i,j in enumerate(d1['images']):
-        d1['images'][i]['id']= b1[d1['images'][i]['id']]
+        j['id']= b1[j['id']]
     for i,j in enumerate(d2['images']):
-        d2['images'][i]['id']= b2[d2['images'][i]['id']]
+        j['id']= b2[j['id']]
         
     #Reset File 1 and 2 annotations ids
     b3={}
     for i,j in enumerate(d1['annotations']):
-        b3[d1['annotations'][i]['id']]=i
+        b3[j['id']]=i
     b4={}
+    max_b3=max(b3)
     for i,j in enumerate(d2['annotations']):
-        b4[d2['annotations'][i]['id']]=max(b3)+i+1
-
-
-
+        b4[j['id']]=max_b3+i+1
 
     for i,j in enumerate(d1['annotations']):
-        d1['annotations'][i]['id']= b3[d1['annotations'][i]['id']]
-        d1['annotations'][i]['image_id']=b1[d1['annotations'][i]['image_id']]
+        j['id']= b3[j['id']]
+        j['image_id']=b1[j['image_id']]
     for i,j in enumerate(d2['annotations']):
-        d2['annotations'][i]['id']= b4[d2['annotations'][i]['id']]
-        d2['annotations'][i]['image_id']=b2[d2['annotations'][i]['image_id']]
-
-    files_check_classes_temp={}
-    pbar = tqdm(total=len(d1['images'])+len(d2['images']))
-    for i,j in enumerate(d1['images']):
-        for ii,jj in enumerate(d1['annotations']):
-            if jj['image_id']==j['id']:
-                try:
-                    files_check_classes_temp[j['file_name']].append(jj['category_id'])
-                except:
-                    pbar.update(1)
-                    files_check_classes_temp[j['file_name']]=[jj['category_id']]
+        j['id']= b4[j['id']]
+        j['image_id']=b2[j['image_id']]
 
-
-    for i,j in enumerate(d2['images']):
-        for ii,jj in enumerate(d2['annotations']):
-            if jj['image_id']==j['id']:
-                try:
-                    files_check_classes_temp[j['file_name']].append(jj['category_id'])
-                except:
-                    pbar.update(1)
-                    files_check_classes_temp[j['file_name']]=[jj['category_id']]
-    pbar.close()
-    added, removed, modified, same = dict_compare(files_check_classes, files_check_classes_temp)
-    assert (len(added)==0 and len(removed)==0 and len(modified)==0),"filenames detected before merging error: "+len(added)+" filenames added "+ len(removed)+" filenames removed "+len(modified)+" filenames' classes modified "+ len(same)+ " filenames entries reserved"
+    files_check_classes_temp=files_classes(d1)
+    files_check_classes_temp.update(files_classes(d2))
+    assert_same_classes(files_check_classes, files_check_classes_temp, "before")
 
     test=d1.copy()
     for i in d2['images']:
@@ -148,25 +146,445 @@ def combine(tt1,tt2,output_file):
     for i in d2['annotations']:
         test['annotations'].append(i)
     test['categories']=d2['categories']
-    files_check_classes_temp={}
-    pbar = tqdm(total=len(test['images']))
-    for i,j in enumerate(test['images']):
-        for ii,jj in enumerate(test['annotations']):
-            if jj['image_id']==j['id']:
-                try:
-                    files_check_classes_temp[j['file_name']].append(jj['category_id'])
-                except:
-                    pbar.update(1)
-                    files_check_classes_temp[j['file_name']]=[jj['category_id']]
 
-    pbar.close()
-    added, removed, modified, same = dict_compare(files_check_classes, files_check_classes_temp)
-    assert (len(added)==0 and len(removed)==0 and len(modified)==0),"filenames detected after merging error: "+len(added)+" filenames added "+ len(removed)+" filenames removed "+len(modified)+" filenames' classes modified "+ len(same)+ " filenames entries reserved"
+    files_check_classes_temp=files_classes(test)
+    assert_same_classes(files_check_classes, files_check_classes_temp, "after")
 
     with open(output_file, 'w') as f:
         json.dump(test,f)
 
 
+class CocoMerger:
+    """ Merge any number of COCO annotated files, one file at a time, where every file only needs to be read once
+
+    Image and annotation ids are kept as they are as long as they are unique across the merged files
+    (which is the case for ids made by a CocoIdGenerator with a different file id per file).
+    An id that is already used gets remapped to a new id above every id used so far,
+    and the image_id of the annotations gets remapped with it.
+
+    A file is only merged if it passes the same checks as combine:
+    1- There shouldn't be duplicate image file names across the files
+    2- The files should have the same categories (same names and ids)
+    If it doesn't, add raises and the merged result stays as it was before the call.
+
+    :param output_file: output file path, written by write
+    """
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.info = None
+        self.licenses = None
+        self.categories = None
+        self.images = []
+        self.annotations = []
+        self.file_names = set()
+        self.image_ids = set()
+        self.annotation_ids = set()
+        self.max_image_id = -1
+        self.max_annotation_id = -1
+
+    def add(self, d):
+        """ Validate one COCO file and add its images and annotations to the merged result
+        :param d: COCO file content (the loaded json dictionary)
+        :return: images and annotations of d with the ids they got in the merged result
+        """
+        images, annotations = self.remap(d)
+        self.accept(images, annotations)
+        return images, annotations
+
+    def seed(self, merged_file, skip_image_ids=()):
+        """ Start from an already merged COCO file, which is trusted and not checked again
+        The merged file is read one image and one annotation at a time (see iter_coco_file),
+        so it is never loaded as a whole (with a StreamingCocoMerger, the memory stays bounded)
+        :param merged_file: merged COCO file path, as written by write
+        :param skip_image_ids: set of image ids whose images and annotations are left out
+        """
+        self.info = {}
+        self.licenses = []
+        for key, value in iter_coco_file(merged_file):
+            if key == 'images':
+                if value['id'] in skip_image_ids:
+                    continue
+                self.file_names.add(value['file_name'])
+                self.image_ids.add(value['id'])
+                self.max_image_id = max(self.max_image_id, value['id'])
+                self.accept([value], [])
+            elif key == 'annotations':
+                if value['image_id'] in skip_image_ids:
+                    continue
+                self.annotation_ids.add(value['id'])
+                self.max_annotation_id = max(self.max_annotation_id, value['id'])
+                self.accept([], [value])
+            elif key in ('info', 'licenses', 'categories'):
+                setattr(self, key, value)
+        # (a StreamingCocoMerger starts its output here, even if every image was left out)
+        self.accept([], [])
+
+    def accept(self, images, annotations):
+        """ Add images and annotations, whose ids are already remapped, to the merged result
+        """
+        self.images.extend(images)
+        self.annotations.extend(annotations)
+
+    def remap(self, d):
+        """ Validate one COCO file and reserve its (remapped) ids and file names in the merged result
+        :param d: COCO file content (the loaded json dictionary)
+        :return: images and annotations of d with the ids they get in the merged result
+        """
+        if self.categories is not None:
+            check_categories(self.categories, d['categories'])
+
+        file_names = set()
+        image_ids = set()
+        for image in d['images']:
+            assert not(image['file_name'] in self.file_names or image['file_name'] in file_names), "Duplicate filenames detected between the files! @" + image['file_name']
+            assert not(image['id'] in image_ids), "Duplicate image id detected in the file! @" + str(image['id'])
+            file_names.add(image['file_name'])
+            image_ids.add(image['id'])
+
+        for annotation in d['annotations']:
+            assert annotation['image_id'] in image_ids, "Annotation {} refers to image id {} which is not in the file".format(annotation['id'], annotation['image_id'])
+
+        # the file passed every check, from here on the merged result gets updated
+        if self.categories is None:
+            self.info = d.get('info', {})
+            self.licenses = d.get('licenses', [])
+            self.categories = d['categories']
+
+        # new ids start above every id of the merged result and of this file, so they cannot collide with either
+        next_image_id = max([self.max_image_id] + [image['id'] for image in d['images']]) + 1
+        image_id_map = {}
+        images = []
+        for image in d['images']:
+            if image['id'] in self.image_ids:
+                image_id_map[image['id']] = next_image_id
+                next_image_id += 1
+            else:
+                image_id_map[image['id']] = image['id']
+            image = dict(image, id=image_id_map[image['id']])
+            self.image_ids.add(image['id'])
+            self.max_image_id = max(self.max_image_id, image['id'])
+            images.append(image)
+
+        next_annotation_id = max([self.max_annotation_id] + [annotation['id'] for annotation in d['annotations']]) + 1
+        annotations = []
+        for annotation in d['annotations']:
+            if annotation['id'] in self.annotation_ids:
+                annotation_id = next_annotation_id
+                next_annotation_id += 1
+            else:
+                annotation_id = annotation['id']
+            annotation = dict(annotation, id=annotation_id, image_id=image_id_map[annotation['image_id']])
+            self.annotation_ids.add(annotation['id'])
+            self.max_annotation_id = max(self.max_annotation_id, annotation['id'])
+            annotations.append(annotation)
+
+        self.file_names.update(file_names)
+
+        return images, annotations
+
+    def write(self):
+        """ Save the merged result
+        """
+        merged = {
+            'info': self.info,
+            'images': self.images,
+            'annotations': self.annotations,
+            'categories': self.categories,
+            'licenses': self.licenses,
+        }
+        with open(self.output_file, 'w') as f:
+            json.dump(merged, f)
+
+
+class StreamingCocoMerger(CocoMerger):
+    """ CocoMerger that writes the merged images and annotations to disk as soon as a file is added,
+    instead of keeping them in memory until write
+
+    Only the ids and file names seen so far stay in memory (to check for duplicates),
+    so the peak memory is bounded by the largest single input file and not by the merged result.
+
+    The images go straight into a temporary output file and the annotations into a second temporary file,
+    which gets appended to the output by write. The output file is only replaced once write finishes,
+    and has the same content json.dump would give for the in-memory merge.
+
+    :param output_file: output file path
+    """
+    def __init__(self, output_file):
+        super().__init__(output_file)
+        self.images_file = None
+        self.annotations_file = None
+        self.num_images = 0
+        self.num_annotations = 0
+
+    def accept(self, images, annotations):
+        """ Append images and annotations, whose ids are already remapped, to the temporary files
+        """
+        if self.images_file is None:
+            self.images_file = open(self.output_file + '.tmp', 'w')
+            self.annotations_file = open(self.output_file + '.annotations.tmp', 'w+')
+            self.images_file.write('{"info": ' + json.dumps(self.info) + ', "images": [')
+
+        for image in images:
+            self.images_file.write((', ' if self.num_images > 0 else '') + json.dumps(image))
+            self.num_images += 1
+        for annotation in annotations:
+            self.annotations_file.write((', ' if self.num_annotations > 0 else '') + json.dumps(annotation))
+            self.num_annotations += 1
+
+    def write(self):
+        """ Join the images and annotations into the output file
+        """
+        self.images_file.write('], "annotations": [')
+        self.annotations_file.seek(0)
+        shutil.copyfileobj(self.annotations_file, self.images_file)
+        self.images_file.write('], "categories": ' + json.dumps(self.categories) + ', "licenses": ' + json.dumps(self.licenses) + '}')
+
+        self.images_file.close()
+        self.annotations_file.close()
+        os.remove(self.annotations_file.name)
+        os.replace(self.images_file.name, self.output_file)
+
+
+def read_coco_file(input_file):
+    """ Read a COCO file, hashing the content on the way so the file is only read once
+    :param input_file: COCO file path
+    :return: COCO file content (the loaded json dictionary), sha256 of the file
+    """
+    with open(input_file, 'rb') as f:
+        content = f.read()
+    return json.loads(content), hashlib.sha256(content).hexdigest()
+
+
+def iter_coco_file(input_file, chunk_size=1 << 20):
+    """ Read a COCO file one record at a time, without loading the whole file
+    Every element of the "images" and "annotations" lists is yielded on its own, every other key with its whole value
+    :param input_file: COCO file path
+    :param chunk_size: number of characters read at once
+    :return: generator of (key, value), e.g. ('info', {...}), ('images', image), ..., ('annotations', annotation), ...
+    """
+    decoder = json.JSONDecoder()
+    with open(input_file) as f:
+        buffer = ''
+        position = 0
+        at_end = False
+
+        def next_char():
+            # skips the whitespace, and reads more of the file when the buffer runs out
+            nonlocal buffer, position, at_end
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n':
+                    position += 1
+                if position < len(buffer) or at_end:
+                    return buffer[position] if position < len(buffer) else ''
+                read_more()
+
+        def read_more():
+            nonlocal buffer, position, at_end
+            chunk = f.read(chunk_size)
+            at_end = chunk == ''
+            buffer = buffer[position:] + chunk
+            position = 0
+
+        def expect(char):
+            nonlocal position
+            assert next_char() == char, "Expected {} at character {} of {}".format(char, position, input_file)
+            position += 1
+
+        def decode():
+            # a value is only complete if something follows it (a number could go on in the next chunk)
+            nonlocal position
+            next_char()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                    if end < len(buffer) or at_end:
+                        position = end
+                        return value
+                except json.JSONDecodeError:
+                    if at_end:
+                        raise
+                read_more()
+
+        expect('{')
+        while next_char() != '}':
+            if next_char() == ',':
+                expect(',')
+            key = decode()
+            expect(':')
+            if key in ('images', 'annotations') and next_char() == '[':
+                expect('[')
+                while next_char() != ']':
+                    if next_char() == ',':
+                        expect(',')
+                    yield key, decode()
+                expect(']')
+            else:
+                yield key, decode()
+
+
+def file_sha256(input_file):
+    """ sha256 of a file, read in chunks
+    """
+    sha256 = hashlib.sha256()
+    with open(input_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def id_ranges(ids):
+    """ Compress ids into runs of consecutive ids
+    :param ids: iterable of int
+    :return: list of [first id, last id] (both inclusive)
+    """
+    ranges = []
+    for i in sorted(ids):
+        if ranges != [] and ranges[-1][1] + 1 == i:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ranges
+
+
+def manifest_entry(sha256, images, annotations):
+    """ Manifest record of one COCO file that got merged
+    :param sha256: sha256 of the COCO file
+    :param images: images of the COCO file, with the ids they got in the merged result
+    :param annotations: annotations of the COCO file, with the ids they got in the merged result
+    """
+    return {
+        'sha256': sha256,
+        'num_images': len(images),
+        'num_annotations': len(annotations),
+        'image_id_ranges': id_ranges(image['id'] for image in images),
+        'annotation_id_ranges': id_ranges(annotation['id'] for annotation in annotations),
+    }
+
+
+def write_manifest(manifest_file, output_file, sources, failed=None):
+    """ Save which COCO files are in the merged file, their content hash and the ids they use
+    :param manifest_file: manifest file path
+    :param output_file: merged file path
+    :param sources: dictionary from (normalized) COCO file path to its manifest_entry
+    :param failed: dictionary from (normalized) COCO file path to {'sha256', 'error'} of the files that could not be merged
+    """
+    with open(manifest_file, 'w') as f:
+        json.dump({'merged_file': output_file, 'sources': sources, 'failed': failed or {}}, f, indent=4)
+
+
+def failed_entry(input_file, error):
+    """ Manifest record of one COCO file that could not be merged, None if the file cannot even be hashed
+    (then it is not recorded and gets retried by the next append_many)
+    """
+    try:
+        return {'sha256': file_sha256(input_file), 'error': error}
+    except OSError:
+        return None
+
+
+def combine_many(input_files, output_file, streaming=False, manifest_file=None):
+    """ Combine any number of COCO annotated files and save them into new file, reading every file once
+    A file that cannot be merged is skipped, and the other files still get merged (see CocoMerger)
+    :param input_files: list of COCO file paths, merged in the given order
+    :param output_file: output file path
+    :param streaming: if True, write the merged result while reading the inputs (see StreamingCocoMerger)
+    :param manifest_file: if given, save the manifest of the merged files there (needed by append_many)
+    :return: list of (COCO file path, error traceback) of the files that got skipped
+    """
+    merger = StreamingCocoMerger(output_file) if streaming else CocoMerger(output_file)
+    files_with_errors = []
+    sources = {}
+    failed = {}
+
+    for input_file in tqdm(input_files):
+        try:
+            d, sha256 = read_coco_file(input_file)
+            images, annotations = merger.add(d)
+            sources[os.path.normpath(input_file)] = manifest_entry(sha256, images, annotations)
+        except Exception:
+            files_with_errors.append((input_file, traceback.format_exc()))
+            failed[os.path.normpath(input_file)] = failed_entry(input_file, files_with_errors[-1][1])
+
+    if merger.categories is None:
+        print("No COCO file could be merged, {} is not written".format(output_file))
+    else:
+        merger.write()
+        if manifest_file is not None:
+            write_manifest(manifest_file, output_file, sources, 
+                            {key: entry for key, entry in failed.items() if entry is not None})
+
+    return files_with_errors
+
+
+def append_many(input_files, output_file, manifest_file, streaming=False):
+    """ Bring an already merged file up to date with input_files, using the manifest written by combine_many
+    Only the COCO files that are new or whose content hash changed get read and merged.
+    The images and annotations of a changed or no longer listed COCO file get removed from the merged file first,
+    so a changed file replaces its stale version, and a changed file that cannot be merged anymore is left out.
+    The other COCO files are not read again, and neither is the merged file as a whole (see CocoMerger.seed).
+    A COCO file that could not be merged is recorded in the manifest with its content hash and error,
+    it is only read again once it changes, until then its recorded error is returned again by every call.
+    If there is no merged file or manifest yet, every file gets merged with combine_many.
+    :param input_files: list of COCO file paths that the merged file should contain
+    :param output_file: merged file path
+    :param manifest_file: manifest file path
+    :param streaming: if True, write the merged result while merging (see StreamingCocoMerger)
+    :return: list of (COCO file path, error traceback) of the files that got skipped
+    """
+    if not (os.path.exists(output_file) and os.path.exists(manifest_file)):
+        print("No merged file and manifest to append to, merging all {} files".format(len(input_files)))
+        return combine_many(input_files, output_file, streaming=streaming, manifest_file=manifest_file)
+
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    sources = manifest['sources']
+
+    input_files_by_key = {os.path.normpath(input_file): input_file for input_file in input_files}
+    input_sha256 = {key: file_sha256(input_file) for key, input_file in input_files_by_key.items()}
+
+    # the files that failed before and did not change since, they would fail again
+    failed = {key: entry for key, entry in manifest.get('failed', {}).items() 
+                if key in input_sha256 and key not in sources and entry['sha256'] == input_sha256[key]}
+    files_with_errors = [(input_files_by_key[key], entry['error']) for key, entry in failed.items()]
+
+    stale_keys = [key for key in sources if key not in input_sha256 or sources[key]['sha256'] != input_sha256[key]]
+    new_keys = [key for key in input_files_by_key 
+                if (key not in sources or sources[key]['sha256'] != input_sha256[key]) and key not in failed]
+
+    if stale_keys == [] and new_keys == []:
+        print("{} is up to date with all {} files ({} of them could not be merged and did not change)".format(output_file, len(input_files), len(failed)))
+        if failed != manifest.get('failed', {}):
+            write_manifest(manifest_file, output_file, sources, failed)
+        return files_with_errors
+
+    print("Appending {} new or changed files, removing {} stale files, keeping {} files".format(len(new_keys), len(stale_keys), len(sources) - len(stale_keys)))
+
+    stale_image_ids = set()
+    for key in stale_keys:
+        for first_id, last_id in sources.pop(key)['image_id_ranges']:
+            stale_image_ids.update(range(first_id, last_id + 1))
+
+    merger = StreamingCocoMerger(output_file) if streaming else CocoMerger(output_file)
+    merger.seed(output_file, stale_image_ids)
+
+    for key in tqdm(new_keys):
+        input_file = input_files_by_key[key]
+        try:
+            d, sha256 = read_coco_file(input_file)
+            images, annotations = merger.add(d)
+            sources[key] = manifest_entry(sha256, images, annotations)
+        except Exception:
+            files_with_errors.append((input_file, traceback.format_exc()))
+            entry = failed_entry(input_file, files_with_errors[-1][1])
+            if entry is not None:
+                failed[key] = entry
+
+    merger.write()
+    write_manifest(manifest_file, output_file, sources, failed)
+
+    return files_with_errors
+
+
 if __name__ == '__main__':
     if "-h" in sys.argv:
         print('''\nUsage: python {} <path_to_file_1> <path_to_file_2> <output_file>
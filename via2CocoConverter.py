@@ -1,10 +1,18 @@
 from datetime import date
 import os
 import json
-import ffmpeg
+import random
 from math import ceil
 import traceback
-from merge_coco.merge import combine
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import merge_coco.merge
+from merge_coco.merge import combine_many, append_many
+import videoProbeCache
+from videoProbeCache import getVideoInfo
+from buildCache import fileFingerprint, videoFingerprint, codeFingerprint, configFingerprint
+import cocoIdGenerator
+from cocoIdGenerator import CocoIdGenerator
 
 """
 Constant declaration (from config file)
@@ -44,8 +52,21 @@ Parameters:
           the via annotation json would just have "_2" at the end
   video_dir - string, path to the directory that contains all the videos
   coco_json_dir - string, path to the directory where we would save the coco annotation jsons
-"""
-def convertAllViaToCoco(via_json_dir, video_dir, coco_json_dir):
+  num_workers - int, default = 1
+    number of processes used to convert the via annotations
+      if it is 1, the via annotations get converted one after another in the current process
+      the file ids are always assigned from the sorted filename order, no matter how many workers are used
+  build_cache - BuildCache object, default = None
+    if given, a via annotation is only converted if the via json, the video, the config file or the code changed
+      since its coco json was built
+  annotated_images_only - bool, default = False
+    if True, the coco jsons only have the images (frames) that have annotations, instead of every frame of the video
+  negative_fraction - float, default = 0.0
+    with annotated_images_only, fraction of the frames without annotations that also get an image, as negative samples
+      (the same frames as the ones extracted by convertAllVideosToFrames with the same negative_fraction)
+"""
+def convertAllViaToCoco(via_json_dir, video_dir, coco_json_dir, num_workers=1, build_cache=None, 
+                          annotated_images_only=False, negative_fraction=0.0):
     via_json_files = []
 
     for dirpath, _, filenames in os.walk(via_json_dir):
@@ -57,27 +78,43 @@ def convertAllViaToCoco(via_json_dir, video_dir, coco_json_dir):
             if os.path.splitext(f)[1] == ".json":
                 via_json_files.append(os.path.join(dirpath, f))
     
-    # keeps track of via annotations that have problem during conversion
-    via_json_with_errors = []
+    # (via json path, file id) for every conversion that has to run
+    conversion_list = [(via_json_files[i], i) for i in range(len(via_json_files))]
 
-    for i in range(len(via_json_files)):
-        via_json_file = via_json_files[i]
+    if build_cache != None:
+        conversion_fingerprints = {}
+        for via_json_file, i in conversion_list:
+            conversion_fingerprints[via_json_file] = getConversionFingerprint(via_json_file, video_dir, i, 
+                                                                              annotated_images_only, negative_fraction)
 
-        try: 
-            convertToCocoFormat(via_json_file, video_dir, coco_json_dir, file_id = i)
-        except:
-            trace_error = traceback.format_exc()
-            
-            print(trace_error)
+        conversion_list = [(via_json_file, i) for via_json_file, i in conversion_list 
+                            if not build_cache.isUpToDate("via2coco", getCocoJsonSavePath(via_json_file, coco_json_dir), 
+                                                            conversion_fingerprints[via_json_file], 
+                                                            [getCocoJsonSavePath(via_json_file, coco_json_dir)])]
 
-            print("xxxxxxxxxxx WARNING! xxxxxxxxxxx")
-            print(f"xxxxxxx video id = {i}, via json name = {via_json_file} xxxxxxx")
-            print()
-            
-            via_json_with_errors.append((via_json_file, i, trace_error))
+    # keeps track of via annotations that have problem during conversion
+    via_json_with_errors = []
 
-            pass
+    if num_workers <= 1:
+        for via_json_file, i in conversion_list:
+            trace_error = convertToCocoFormatWithTrace(via_json_file, video_dir, coco_json_dir, i, 
+                                                        annotated_images_only, negative_fraction)
 
+            if trace_error != None:
+                via_json_with_errors.append((via_json_file, i, trace_error))
+    else:
+        via_json_with_errors = convertAllViaToCocoInPool(conversion_list, video_dir, coco_json_dir, num_workers, 
+                                                          annotated_images_only, negative_fraction)
+
+    # keep the error log in file id order, independent of the order the workers finished in
+    via_json_with_errors = sorted(via_json_with_errors, key=lambda x: x[1])
+
+    if build_cache != None:
+        via_json_files_with_errors = [fpath for fpath, _, _ in via_json_with_errors]
+        for via_json_file, _ in conversion_list:
+            if via_json_file not in via_json_files_with_errors and conversion_fingerprints[via_json_file] != None:
+                build_cache.record("via2coco", getCocoJsonSavePath(via_json_file, coco_json_dir), conversion_fingerprints[via_json_file])
+        build_cache.save()
     
     if via_json_with_errors != []:
       with open(f"{os.path.join(LOGS_DIR, 'via2coco_error_log.txt')}", "w") as f:
@@ -112,8 +149,11 @@ Parameters:
   video_dir - string, path to the directory that contains all the videos
   coco_json_dir - string, path to the directory where we would save the coco annotation jsons
   file_id - int, unique identifier for a particular via annotation
+  annotated_images_only - bool, default = False
+    if True, only the frames that have annotations get an image (and a negative_fraction of the others)
+  negative_fraction - float, default = 0.0, see convertAllViaToCoco
 """
-def convertToCocoFormat(via_json_path, video_dir, coco_json_dir, file_id):
+def convertToCocoFormat(via_json_path, video_dir, coco_json_dir, file_id, annotated_images_only=False, negative_fraction=0.0):
   with open(via_json_path, 'r') as f:
     via_json = json.load(f)
 
@@ -126,27 +166,38 @@ def convertToCocoFormat(via_json_path, video_dir, coco_json_dir, file_id):
   video_filename = via_json["file"]["1"]["fname"]
   video_path = video_dir + video_filename
   
-  vid_info = ffmpeg.probe(video_path)
+  # only probes the video if it is not in the video probe cache yet
+  vid_info = getVideoInfo(video_path)
 
-  # Source: https://stackoverflow.com/questions/7362130/getting-video-dimension-resolution-width-x-height-from-ffmpeg
-  height = int(vid_info['streams'][0]['height'])
-  width = int(vid_info['streams'][0]['width'])
+  height = vid_info['height']
+  width = vid_info['width']
   print(f"h = {height}, w = {width}")
 
-  # Source: https://stackoverflow.com/questions/3844430/how-to-get-the-duration-of-a-video-in-python
-  vid_length = float(vid_info['format']['duration'])
+  vid_length = vid_info['duration']
   print(f"vid length (in sec): {vid_length}")
   print()
 
-  coco_json_save_path = coco_json_dir + via_json_name + "_coco.json"
+  coco_json_save_path = getCocoJsonSavePath(via_json_path, coco_json_dir)
 
   # create the annotation id and image id generator for this conversion
   idGen = CocoIdGenerator(file_id = file_id)
 
+  cocoAnnotations = createCocoAnnotationDict(via_json["metadata"], via_json["attribute"], vid_length, idGen)
+
+  # None gives an image for every frame
+  frame_numbers = None
+  if annotated_images_only:
+    num_frames = ceil(vid_length * 10)
+    annotated_frame_numbers = set(idGen.decodeImageId(ann["image_id"])[1] for ann in cocoAnnotations)
+    annotated_frame_numbers = set(z for z in annotated_frame_numbers if z < num_frames)
+
+    negative_frame_numbers = getNegativeFrameNumbers(annotated_frame_numbers, num_frames, negative_fraction, via_json_name)
+    frame_numbers = sorted(annotated_frame_numbers.union(negative_frame_numbers))
+
   coco_json = {
                   "info": createCocoInfoDict(via_json_name), 
-                  "images": createCocoImageDict(width, height, vid_length, via_json_name, idGen), 
-                  "annotations": createCocoAnnotationDict(via_json["metadata"], via_json["attribute"], vid_length, idGen), 
+                  "images": createCocoImageDict(width, height, vid_length, via_json_name, idGen, frame_numbers), 
+                  "annotations": cocoAnnotations, 
                   "categories": createCocoCategories(),
                   "licenses": createCocoLisenses(),
                 }
@@ -158,47 +209,58 @@ def convertToCocoFormat(via_json_path, video_dir, coco_json_dir, file_id):
 
 
 """
-Use the Coco merge function from 
+Use the Coco merge engine from merge_coco (combine_many)
 
 And merge all the coco json files together into one coco json
+  every coco json is only read once, and the merged coco json is written once
+  a coco json that cannot be merged (e.g. duplicate frame filenames or different categories) gets skipped 
+    and logged, the others still get merged
 
 Parameters:
   coco_json_dir - string, path to the coco json
   merged_save_path - string, path to save the merged coco json
-"""
-def mergeAllCoco(coco_json_dir, merged_save_path):
+  streaming - bool, default = False
+    if True, the merged images and annotations get written to disk while the coco jsons are read,
+      so the memory needed is bounded by the largest single coco json instead of the merged coco json
+  append - bool, default = False
+    if True, only the coco jsons that are new or changed since the last merge get merged into the existing merged coco json
+      the coco jsons in the merged coco json, their content hash and ids are kept in a manifest json next to it
+        ({merged_save_path without .json}_manifest.json), which is written by every merge
+  build_cache - BuildCache object, default = None
+    if given, the merge is skipped if none of the coco jsons and the code changed since the merged coco json was built
+"""
+def mergeAllCoco(coco_json_dir, merged_save_path, streaming=False, append=False, build_cache=None):
     coco_json_files = []
 
     for dirpath, _, filenames in os.walk(coco_json_dir):
-        for f in filenames:
+        # sort ascending order, so the merged coco json does not depend on the order of os.walk
+        for f in sorted(filenames):
             if os.path.splitext(f)[1] == ".json":
                 coco_json_files.append(os.path.join(dirpath, f))
-    
-    # make the first coco json file the "starting" merged file
-    merged_coco_file = coco_json_files[0]
-
-    coco_json_with_errors = []
-
-    for i in range(1, len(coco_json_files)):
-        try: 
-            coco_json_path = coco_json_files[i]
-
-            if i != 1:
-                merged_coco_file = merged_save_path
-                
-            combine(merged_coco_file, coco_json_path, merged_save_path)
-        except:
-            trace_error = traceback.format_exc()
-            
-            print(trace_error)
 
-            print("xxxxxxxxxxx WARNING! xxxxxxxxxxx")
-            print(f"xxxxxxx filename = {coco_json_path} xxxxxxx")
-            print()
-            
-            coco_json_with_errors.append((coco_json_path, trace_error))
+    manifest_path = getMergeManifestPath(merged_save_path)
+
+    if build_cache != None:
+        merge_fingerprint = {
+                              "coco_jsons": {f: fileFingerprint(f) for f in coco_json_files}, 
+                              "code": codeFingerprint([os.path.abspath(__file__), merge_coco.merge.__file__]),
+                            }
+
+        if build_cache.isUpToDate("merge", merged_save_path, merge_fingerprint, [merged_save_path, manifest_path]):
+            print(f"{merged_save_path} is up to date, skipping the merge")
+            return
 
-            pass
+    if append:
+        coco_json_with_errors = append_many(coco_json_files, merged_save_path, manifest_path, streaming=streaming)
+    else:
+        coco_json_with_errors = combine_many(coco_json_files, merged_save_path, streaming=streaming, manifest_file=manifest_path)
+
+    for coco_json_path, trace_error in coco_json_with_errors:
+        print(trace_error)
+
+        print("xxxxxxxxxxx WARNING! xxxxxxxxxxx")
+        print(f"xxxxxxx filename = {coco_json_path} xxxxxxx")
+        print()
     
     if coco_json_with_errors != []:
       with open(f"{os.path.join(LOGS_DIR, 'cocomerge_error_log.txt')}", "w") as f:
@@ -216,101 +278,10 @@ def mergeAllCoco(coco_json_dir, merged_save_path):
             f.write(f"{fn}\n")
             f.write(f"{em}\n\n")
 
-
-"""
-====================================================================================================
-
-    Annotation id and image id generator for converting VIA annotations to Coco json
-
-====================================================================================================
-"""
-class CocoIdGenerator:
-    """
-    Coco Id Generator generates the correct annotation id and image id in the following format:
-    
-    If digits_for_file=3, digits_for_frame=5, digits_for_obj=3, 
-    then the id would be formatted as the following:
-        _ _ _ _ _ _ _ _ _ _ _
-
-    where if we break it down into sections:
-        _ _ _   _ _ _ _ _ _   _ _ _
-       {  1  } {     2     } {  3  }
-
-    and each section is semantically defined as
-        1 = the file id, unique for each VIA annotation
-        2 = the frame id, unique for each frame in the video (in units of 0.1 sec)
-        3 = the object id, unique for each identified object in a video
-
-
-    Parameters:
-        file_id - id, the video id for this particular via annotation
-        digits_for_file - int, default = 3
-            For the file id in the generated annotation id and image id, it gets allocated {digits_for_file} digits
-        digits_for_frame - int, default = 5
-            For the frame id in the generated annotation id and image id, it gets allocated {digits_for_frame} digits
-        digits_for_obj - int, default = 3
-            For the object id in the  generated annotation id and image id, it gets allocated {digits_for_obj} digits
-    """
-    def __init__(self, file_id, digits_for_file=3, digits_for_frame=5, digits_for_obj=3):
-        self.file_id = file_id
-        self.digits_for_file = digits_for_file
-        self.digits_for_frame = digits_for_frame
-        self.digits_for_obj = digits_for_obj
-
-
-    """
-    Before the image id gets converted to integer (will lose any leading 0s), the image id has the format:
-        _ ... _   _ _ ... _ _  
-       {   1   } {     2     }
-
-    and each section is semantically defined as
-        1 = the file id, unique for each VIA annotation, has self.digits_for_file number of digits
-        2 = the frame id, unique for each frame in the video (in units of 0.1 sec), has self.digits_for_frame number of digits
-
-    Parameters:
-        curr_time_int - int, the current time stamp in unit in 0.1 second
-
-    Return:
-        image id as an interger (losing the leading 0s)
-    """
-    def generateImageId(self, curr_time_int):
-        file_sec = str(self.file_id)
-        file_sec = file_sec.zfill(self.digits_for_file)
-        
-        image_sec = str(curr_time_int)
-        image_sec = image_sec.zfill(self.digits_for_frame)
-
-        return int(file_sec + image_sec)
-
-
-    """
-    Before the annotation id gets converted to integer (will lose any leading 0s), the annotation id has the format:
-        _ ... _   _ _ ... _ _   _ ... _
-       {   1   } {     2     } {   3   }
-
-    and each section is semantically defined as
-        1 = the file id, unique for each VIA annotation, has self.digits_for_file number of digits
-        2 = the frame id, unique for each frame in the video (in units of 0.1 sec), has self.digits_for_frame number of digits
-        3 = the object id, unique for each identified object in a video, has self.digits_for_object number of digits
-
-    Parameters:
-        curr_time_int - int, the current time stamp in unit in 0.1 second
-        obj_id - int, unique identifier for the object that appears at a particular time stamp
-
-    Return:
-        annotation id as an interger (losing the leading 0s)
-    """
-    def generateAnnId(self, curr_time_int, obj_id):
-        file_sec = str(self.file_id)
-        file_sec = file_sec.zfill(self.digits_for_file)
-        
-        image_sec = str(curr_time_int)
-        image_sec = image_sec.zfill(self.digits_for_frame)
-        
-        obj_sec = str(obj_id)
-        obj_sec = obj_sec.zfill(self.digits_for_obj)
-
-        return int(file_sec + image_sec + obj_sec)
+    # only record a merge that included every coco json, so the ones with errors get retried next time
+    if build_cache != None and coco_json_with_errors == []:
+        build_cache.record("merge", merged_save_path, merge_fingerprint)
+        build_cache.save()
 
 
 """
@@ -344,6 +315,8 @@ def createCocoInfoDict(video_filename):
 """
 Generate a list of images in Coco format that appear in this annotatations
 
+The fields that are the same for every frame are only computed once, and the image ids are generated all at once
+
 Parameter:
   w - int, width of the frame in pixel
   h - int, height of the frame in pixel
@@ -351,28 +324,33 @@ Parameter:
   video_filename - string, the frame filename will be defined as {video_filename}_{frame id}.jpg
     video_filename here would be the same as via annotation's filename
   idGenerator - CocoIdGenerator object, helps generate image id
+  frame_numbers - list of int, default = None
+    the frame numbers (in units of 0.1 sec) that get an image, if None, every frame of the video gets an image
 """
-def createCocoImageDict(w, h, highest_z, video_filename, idGenerator):
-  cocoImages = []
-
+def createCocoImageDict(w, h, highest_z, video_filename, idGenerator, frame_numbers=None):
   # iterate in each frame
   #   notice that z is an integer (represents time in 0.1 seconds)
-  for z in range(0, ceil(highest_z * 10)):
-    # z is essentially the frame number
-    image_num_in_filename = str(z)
-    image_num_in_filename = image_num_in_filename.zfill(idGenerator.digits_for_obj)
+  if frame_numbers == None:
+    frame_numbers = range(0, ceil(highest_z * 10))
+
+  date_captured = date.today().strftime("%m/%d/%Y")
+  image_ids = idGenerator.generateImageIds(frame_numbers).tolist()
 
-    image_filename = f"{video_filename}_" + image_num_in_filename + ".jpg"
+  cocoImages = []
+
+  for z, image_id in zip(frame_numbers, image_ids):
+    # z is essentially the frame number, with the same number of digits as in the frame filenames of video2FrameConverter
+    image_filename = f"{video_filename}_{z:0{idGenerator.digits_for_frame}d}.jpg"
     
     cocoImages.append({
-                        "id": idGenerator.generateImageId(z), 
+                        "id": image_id, 
                         "width": w, 
                         "height": h, 
                         "file_name": image_filename, 
                         "license": 0, 
                         "flickr_url": "", 
                         "coco_url": "", 
-                        "date_captured": date.today().strftime("%m/%d/%Y"),
+                        "date_captured": date_captured,
     })
 
   return cocoImages
@@ -487,6 +465,96 @@ def createCocoLisenses():
 ====================================================================================================
 """
 
+"""
+Run convertToCocoFormat for ONE via annotation, but instead of raising, return the error
+
+Since the function does not raise, it is safe to use as the work item of a worker process
+
+Parameters:
+  same as convertToCocoFormat
+
+Return:
+  None if the conversion succeeded, otherwise the traceback of the error as a string
+"""
+def convertToCocoFormatWithTrace(via_json_file, video_dir, coco_json_dir, file_id, annotated_images_only=False, negative_fraction=0.0):
+  try: 
+    convertToCocoFormat(via_json_file, video_dir, coco_json_dir, file_id = file_id, 
+                          annotated_images_only = annotated_images_only, negative_fraction = negative_fraction)
+  except:
+    trace_error = traceback.format_exc()
+
+    print(trace_error)
+
+    print("xxxxxxxxxxx WARNING! xxxxxxxxxxx")
+    print(f"xxxxxxx video id = {file_id}, via json name = {via_json_file} xxxxxxx")
+    print()
+
+    return trace_error
+
+  return None
+
+
+"""
+Convert the via annotations in {conversion_list} with a pool of {num_workers} processes
+
+If a worker process dies (e.g. gets killed by the OS), the whole pool breaks and every conversion 
+  that has not finished yet gets lost with it. 
+  Those conversions get retried once in a new pool, and whatever gets lost again is converted in its own process,
+  so the conversion that kills its worker only gets recorded as an error and does not abort the rest of the batch
+
+Parameters:
+  conversion_list - list of (via json path, file id)
+  video_dir - string, path to the directory that contains all the videos
+  coco_json_dir - string, path to the directory where we would save the coco annotation jsons
+  num_workers - int, number of worker processes
+  annotated_images_only, negative_fraction - see convertAllViaToCoco
+
+Return:
+  list of (via json path, file id, traceback of the error) for the conversions that failed
+"""
+def convertAllViaToCocoInPool(conversion_list, video_dir, coco_json_dir, num_workers, annotated_images_only=False, negative_fraction=0.0):
+  via_json_with_errors = []
+
+  for pool_size in [num_workers, num_workers, 1]:
+    crashed_conversion_list = []
+
+    # a pool of size 1 converts each of the remaining via annotations in its own process
+    for conversion_sublist in ([conversion_list] if pool_size > 1 else [[c] for c in conversion_list]):
+      with ProcessPoolExecutor(max_workers=pool_size) as executor:
+        future_to_conversion = {}
+        for via_json_file, i in conversion_sublist:
+          future = executor.submit(convertToCocoFormatWithTrace, via_json_file, video_dir, coco_json_dir, i, 
+                                    annotated_images_only, negative_fraction)
+          future_to_conversion[future] = (via_json_file, i)
+
+        for future in as_completed(future_to_conversion):
+          via_json_file, i = future_to_conversion[future]
+
+          try:
+            trace_error = future.result()
+          except BrokenProcessPool:
+            crashed_conversion_list.append((via_json_file, i))
+            continue
+
+          if trace_error != None:
+            via_json_with_errors.append((via_json_file, i, trace_error))
+
+    if crashed_conversion_list == []:
+      return via_json_with_errors
+
+    conversion_list = sorted(crashed_conversion_list, key=lambda x: x[1])
+
+  # the conversions that still crash the process they run in
+  for via_json_file, i in conversion_list:
+    print("xxxxxxxxxxx WARNING! xxxxxxxxxxx")
+    print(f"xxxxxxx worker process crashed, video id = {i}, via json name = {via_json_file} xxxxxxx")
+    print()
+
+    via_json_with_errors.append((via_json_file, i, "worker process crashed during the conversion (BrokenProcessPool)"))
+
+  return via_json_with_errors
+
+
 """
 Based on the attribute dictionary {attr_dict} for a particular object annotation, 
   find the category id (in the coco format) and the object id (in the original via format) for that object
@@ -628,6 +696,63 @@ def getCurrObjId(curr_time, cat_id, og_obj_id, curr_obj_id_dict):
     return curr_obj_id, curr_obj_id_dict
 
 
+"""
+Return the path where the coco json converted from the via annotation at {via_json_path} gets saved
+"""
+def getCocoJsonSavePath(via_json_path, coco_json_dir):
+  return coco_json_dir + getFilenameWithoutPath(via_json_path) + "_coco.json"
+
+
+"""
+Return the fingerprint of everything the conversion of ONE via annotation depends on (used with a BuildCache):
+  the via json, the video, the config file, the code, the file id and which images are written
+
+Return None if the fingerprint cannot be computed (e.g. the video does not exist), 
+  the conversion then always runs and reports the actual error
+"""
+def getConversionFingerprint(via_json_path, video_dir, file_id, annotated_images_only=False, negative_fraction=0.0):
+  try:
+    with open(via_json_path, 'r') as f:
+      video_filename = json.load(f)["file"]["1"]["fname"]
+
+    return {
+            "via_json": fileFingerprint(via_json_path), 
+            "video": videoFingerprint(video_dir + video_filename), 
+            "config": configFingerprint(), 
+            "code": codeFingerprint([os.path.abspath(__file__), videoProbeCache.__file__, cocoIdGenerator.__file__]), 
+            "file_id": file_id,
+            "annotated_images_only": annotated_images_only, 
+            "negative_fraction": negative_fraction if annotated_images_only else 0.0,
+    }
+  except:
+    return None
+
+
+"""
+Return the path of the manifest json that keeps track of the coco jsons in the merged coco json at {merged_save_path}
+"""
+def getMergeManifestPath(merged_save_path):
+  return os.path.splitext(merged_save_path)[0] + "_manifest.json"
+
+
+"""
+Return the frame numbers of the negative samples: a {negative_fraction} of the frames in range({num_frames})
+  that are not in {frame_numbers} (the annotated frames), picked at random
+
+They are always the same ones for the same {seed} (e.g. the via json name),
+  so the coco json and the extracted frames (see video2FrameConverter) pick the same negative samples
+"""
+def getNegativeFrameNumbers(frame_numbers, num_frames, negative_fraction, seed):
+  if negative_fraction <= 0:
+    return []
+
+  frame_numbers_without_ann = [z for z in range(num_frames) if z not in frame_numbers]
+  num_negatives = round(len(frame_numbers_without_ann) * negative_fraction)
+
+  rng = random.Random(seed)
+  return rng.sample(frame_numbers_without_ann, num_negatives)
+
+
 """
 Given a string that contains a filepath, return the filename without the path and extension
 """
@@ -2,6 +2,18 @@ import subprocess
 import os
 import traceback
 import json
+import hashlib
+import tempfile
+from math import ceil
+from itertools import count
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+import videoProbeCache
+from videoProbeCache import getVideoInfo
+from buildCache import videoFingerprint, codeFingerprint
+from via2CocoConverter import getCocoJsonSavePath, getFilenameWithoutPath, getNegativeFrameNumbers
+from cocoIdGenerator import decodeImageId
+from frameShard import FrameShardWriter, iterJpegFrames, getFrameShardPath, getShardIndexPath, READ_CHUNK_SIZE
 
 """
 Constant declaration (from config file)
@@ -19,6 +31,8 @@ LOGS_DIR = config_json["logs_dir"]
           if you want to convert ALL the videos in directory to frames
       - convertToCocoFormat
           if you want to convert ONE video to frames
+      - convertVideoToShard
+          if you want to convert ONE video to a shard of frames
       - generatetVidToFileIdMap
           if you want to generate the json that will make the video filenames to their file ids 
 ====================================================================================================
@@ -28,8 +42,10 @@ LOGS_DIR = config_json["logs_dir"]
 Convert all the videos in {video_dir} to frames based on the via_json_dir filenames
 
 Note that
-    if there are two annotations for the video, we actually convert the video frame twice
+    if there are two annotations for the video, there are two sets of the video frames
         one set of the video frames will have _2 in the filename
+    but the video only gets decoded once, the second set of the video frames are links to the first set
+        (see convertVideoToFramesOnce)
 
 Warning:
     All the directory path should end with "/"
@@ -44,11 +60,31 @@ Parameters:
         Warning: 
         - we assume that all video ends in .mp4
     video_frame_dir - string, directory where we would save the frames
+    num_jobs - int, default = 1
+        number of ffmpeg processes that run at the same time
+    threads_per_job - int, default = 0
+        number of threads each ffmpeg process may use, 0 lets ffmpeg decide
+    build_cache - BuildCache object, default = None
+        if given, a video is only converted to frames if the video or the code changed since its frames were extracted
+    coco_json_dir - string, default = None
+        if given, only the frames that have annotations get extracted (see getFrameNumbersToExtract),
+            instead of every frame of the video
+    negative_fraction - float, default = 0.0
+        only used with coco_json_dir, fraction of the frames without annotations that also get extracted as negative samples
+    link_mode - string, default = "hardlink"
+        how the frames of the second annotation of a video link to the frames of the first one, "hardlink" or "symlink"
+    downscale_factors - list of int, default = []
+        for every factor d, the frames also get saved with width and height divided by d,
+            in the directory downscale_{d} inside video_frame_dir, from the same decode of the video
+    shard - bool, default = False
+        if True, the frames of every video are written to one shard file (see convertVideoToShard and frameShard.py)
+            instead of one jpg file per frame
 """
-def convertAllVideosToFrames(via_json_dir, video_dir, video_frame_dir):
+def convertAllVideosToFrames(via_json_dir, video_dir, video_frame_dir, num_jobs=1, threads_per_job=0, build_cache=None, 
+                                coco_json_dir=None, negative_fraction=0.0, link_mode="hardlink", downscale_factors=[], shard=False):
     frame_filename_list = []
 
-    for _, _, filenames in os.walk(via_json_dir):
+    for dirpath, _, filenames in os.walk(via_json_dir):
         # sort ascending
         filenames_sorted = sorted(filenames)
 
@@ -63,29 +99,94 @@ def convertAllVideosToFrames(via_json_dir, video_dir, video_frame_dir):
                 video_filename += ".mp4"
                 frame_filename = os.path.splitext(f)[0] + "_%05d.jpg"
                 
-                # save both path to the actual video file and the path to save the frames
-                frame_filename_list.append((os.path.join(video_dir, video_filename), os.path.join(video_frame_dir, frame_filename)))
-
-    video_with_error = []
-
-    for video_path, video_frame_path in frame_filename_list: 
-        try: 
-            convertVideoToFrame(video_path, video_frame_path)
-            print()
+                # save both path to the actual video file and the path to save the frames (and the via json they come from)
+                frame_filename_list.append((os.path.join(video_dir, video_filename), os.path.join(video_frame_dir, frame_filename), 
+                                            os.path.join(dirpath, f)))
 
-        except:
-            trace_error = traceback.format_exc()
+    # video path -> list of (video frame path, frame numbers) for every annotation of the video
+    #   frame numbers is None if every frame gets extracted
+    frame_outputs_by_video = {}
+    # video paths that have at least one set of frames that is not up to date
+    stale_video_paths = set()
+    frame_fingerprints = {}
 
-            print(trace_error)
-
-            print("xxxxxxxxxxx WARNING! xxxxxxxxxxx")
-            print(f"xxxxxxx video path = {video_path} xxxxxxx")
-            print(f"xxxxxxx video frame path = {video_frame_path} xxxxxxx")
-            print()
-            
-            video_with_error.append((video_path, video_frame_path, trace_error))
+    video_with_error = []
 
-            pass
+    for video_path, video_frame_path, via_json_path in frame_filename_list: 
+        frame_numbers = None
+        if coco_json_dir != None:
+            try:
+                frame_numbers = getFrameNumbersToExtract(via_json_path, coco_json_dir, video_path, negative_fraction)
+            except:
+                trace_error = traceback.format_exc()
+                print(trace_error)
+                video_with_error.append((video_path, video_frame_path, trace_error))
+                continue
+
+        frame_outputs_by_video.setdefault(video_path, []).append((video_frame_path, frame_numbers))
+
+        if build_cache != None:
+            try:
+                frame_fingerprint = {
+                                      "video": videoFingerprint(video_path), 
+                                      "code": codeFingerprint([os.path.abspath(__file__), videoProbeCache.__file__]),
+                                      "frames": None if frame_numbers == None else hashlib.sha256(str(frame_numbers).encode()).hexdigest(),
+                                      "downscale_factors": list(downscale_factors),
+                                      "shard": shard,
+                                    }
+            except:
+                # e.g. the video does not exist, the conversion reports the actual error
+                frame_fingerprint = None
+
+            # the first frame (or the shard index) is used to tell whether the frames are still there
+            if shard:
+                output_path = getShardIndexPath(getFrameShardPath(video_frame_dir, getFilenameWithoutPath(video_path)))
+            else:
+                first_frame_number = frame_numbers[0] if frame_numbers else 0
+                output_path = video_frame_path % first_frame_number
+            output_paths = [output_path] + [getDownscaledFramePath(output_path, d) for d in downscale_factors]
+
+            if build_cache.isUpToDate("video2frame", video_frame_path, frame_fingerprint, output_paths):
+                print(f"Frames of video = {video_path} are up to date, skipping {video_frame_path}")
+                continue
+
+            frame_fingerprints[video_frame_path] = frame_fingerprint
+
+        stale_video_paths.add(video_path)
+
+    # (video path, list of (video frame path, frame numbers)) for every video that has to be converted to frames
+    #   if one set of frames of a video is not up to date, all sets of frames of the video get redone with the same decode
+    conversion_list = [(video_path, frame_outputs) for video_path, frame_outputs in frame_outputs_by_video.items() 
+                            if video_path in stale_video_paths]
+
+    if shard:
+        conversion_args_list = [(convertVideoToShardWithTrace, video_path, frame_outputs, threads_per_job, downscale_factors) 
+                                    for video_path, frame_outputs in conversion_list]
+    else:
+        conversion_args_list = [(convertVideoToFramesOnceWithTrace, video_path, frame_outputs, threads_per_job, link_mode, downscale_factors) 
+                                    for video_path, frame_outputs in conversion_list]
+
+    if num_jobs <= 1:
+        trace_error_list = (conversion_args[0](*conversion_args[1:]) for conversion_args in conversion_args_list)
+    else:
+        # every job mostly waits on its ffmpeg process, so threads are enough to run the ffmpeg processes concurrently
+        executor = ThreadPoolExecutor(max_workers=num_jobs)
+        futures = [executor.submit(*conversion_args) for conversion_args in conversion_args_list]
+        trace_error_list = (future.result() for future in futures)
+
+    # the results come in the same order as conversion_list, no matter which job finishes first
+    for (video_path, frame_outputs), trace_error in zip(conversion_list, trace_error_list):
+        for video_frame_path, _ in frame_outputs:
+            if trace_error != None:
+                video_with_error.append((video_path, video_frame_path, trace_error))
+            elif build_cache != None and frame_fingerprints.get(video_frame_path) != None:
+                build_cache.record("video2frame", video_frame_path, frame_fingerprints[video_frame_path])
+
+        if build_cache != None:
+            build_cache.save()
+
+    if num_jobs > 1:
+        executor.shutdown()
 
     if video_with_error != []:
         with open(f"{os.path.join(LOGS_DIR, 'video2frame_error_log.txt')}", "w") as f:
@@ -111,24 +212,274 @@ Parameters:
     video_path - string, path to the video file
     video_frame_path - string, path to save the frames
         Warning: frames are saved as .jpg
+    threads - int, default = 0
+        number of threads ffmpeg may use for decoding and encoding, 0 lets ffmpeg decide
+    frame_numbers - list of int, default = None
+        if given, only these frames (in units of 0.1 sec) get extracted, and they keep their frame number in the filename
+        otherwise, every frame gets extracted
+    downscale_factors - list of int, default = []
+        for every factor d, the frames also get saved with width and height divided by d (see getDownscaledFramePath),
+            from the same decode of the video
 """
-def convertVideoToFrame(video_path, video_frame_path):
+def convertVideoToFrame(video_path, video_frame_path, threads=0, frame_numbers=None, downscale_factors=[]):
     print(f"Converting video = {video_path}")
     print(f" To frame filenames = {video_frame_path}")
 
+    # fails early (and ends up in the error log) if the video cannot be read
+    #   the probe result is shared with the via to coco conversion through the video probe cache
+    vid_info = getVideoInfo(video_path)
+    print(f" h = {vid_info['height']}, w = {vid_info['width']}, vid length (in sec): {vid_info['duration']}")
+
+    if frame_numbers == []:
+        print(" No frame to extract")
+        return
+    elif frame_numbers != None:
+        print(f" Extracting {len(frame_numbers)} frames")
+
+    output_paths = [video_frame_path]
+    for d in downscale_factors:
+        downscaled_frame_path = getDownscaledFramePath(video_frame_path, d)
+        os.makedirs(os.path.dirname(downscaled_frame_path), exist_ok=True)
+        print(f" To downscaled (1/{d}) frame filenames = {downscaled_frame_path}")
+
+        output_paths.append(downscaled_frame_path)
+
+    filter_script_path = createFilterScriptPath() if frame_numbers != None else None
+
     # Source on how to run shell scripts in python: https://janakiev.com/blog/python-shell-commands/
-    process = subprocess.Popen(['ffmpeg',  '-i', video_path, 
-                                            '-r', '10', 
-                                            '-start_number', '0', 
-                                            video_frame_path],
-                     stdout=subprocess.PIPE, 
-                     stderr=subprocess.PIPE,
-                     universal_newlines=True)
+    try:
+        process = subprocess.Popen(getFrameExtractionCommand(video_path, output_paths, threads, frame_numbers, downscale_factors, 
+                                                                filter_script_path=filter_script_path),
+                         stdout=subprocess.PIPE, 
+                         stderr=subprocess.PIPE,
+                         universal_newlines=True)
+
+        stdout, stderr = process.communicate()
+    finally:
+        removeFilterScript(filter_script_path)
+
+    printStdOutput(stdout)
+    printStdOutput(stderr)
+
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {process.returncode} when converting video = {video_path}")
+
+
+"""
+Convert ONE video, specified in {video_path}, to the frames of every annotation of the video, decoding the video only once
+
+The frames get extracted for the first annotation in {frame_outputs}, 
+    and the frames of the other annotations are links to those frames (with their own filename), 
+    so the frame filenames in the coco json of every annotation still exist
+
+Parameters:
+    video_path - string, path to the video file
+    frame_outputs - list of (video frame path, frame numbers), one for every annotation of the video
+        frame numbers is None if every frame gets extracted (see convertVideoToFrame)
+    threads - int, default = 0
+        number of threads ffmpeg may use for decoding and encoding, 0 lets ffmpeg decide
+    link_mode - string, default = "hardlink"
+        "hardlink" or "symlink"
+    downscale_factors - list of int, default = [], see convertVideoToFrame
+"""
+def convertVideoToFramesOnce(video_path, frame_outputs, threads=0, link_mode="hardlink", downscale_factors=[]):
+    decoded_frame_path = frame_outputs[0][0]
+
+    # the first set of frames has to contain the frames of every annotation
+    if any(frame_numbers == None for _, frame_numbers in frame_outputs):
+        decoded_frame_numbers = None
+    else:
+        decoded_frame_numbers = sorted(set(z for _, frame_numbers in frame_outputs for z in frame_numbers))
+
+    convertVideoToFrame(video_path, decoded_frame_path, threads, decoded_frame_numbers, downscale_factors)
+
+    for video_frame_path, frame_numbers in frame_outputs[1:]:
+        print(f" Linking frames {video_frame_path} to {decoded_frame_path}")
+
+        if frame_numbers == None:
+            # every frame got extracted, and the frames are numbered from 0
+            frame_numbers = []
+            while os.path.exists(decoded_frame_path % len(frame_numbers)):
+                frame_numbers.append(len(frame_numbers))
+
+        for z in frame_numbers:
+            linkFrame(decoded_frame_path % z, video_frame_path % z, link_mode)
+
+            for d in downscale_factors:
+                linkFrame(getDownscaledFramePath(decoded_frame_path, d) % z, getDownscaledFramePath(video_frame_path, d) % z, link_mode)
+
+
+"""
+Run convertVideoToFramesOnce for ONE video, but instead of raising, return the error
+
+Parameters:
+    same as convertVideoToFramesOnce
+
+Return:
+    None if the conversion succeeded, otherwise the traceback of the error as a string
+"""
+def convertVideoToFramesOnceWithTrace(video_path, frame_outputs, threads=0, link_mode="hardlink", downscale_factors=[]):
+    try: 
+        convertVideoToFramesOnce(video_path, frame_outputs, threads, link_mode, downscale_factors)
+        print()
+    except:
+        trace_error = traceback.format_exc()
+
+        print(trace_error)
+
+        print("xxxxxxxxxxx WARNING! xxxxxxxxxxx")
+        print(f"xxxxxxx video path = {video_path} xxxxxxx")
+        for video_frame_path, _ in frame_outputs:
+            print(f"xxxxxxx video frame path = {video_frame_path} xxxxxxx")
+        print()
+
+        return trace_error
+
+    return None
+
+
+"""
+Convert ONE video, specified in {video_path}, to a shard with the frames of every annotation of the video (see frameShard.py),
+    decoding the video only once
+
+ffmpeg writes the jpgs to a pipe, and they get appended to the shard as they come,
+    so no frame is ever written as its own file.
+    For every downscale factor, the downscaled frames go to their own pipe and shard (in the directory downscale_{d})
+
+Parameters:
+    video_path - string, path to the video file
+    frame_outputs - list of (video frame path, frame numbers), one for every annotation of the video
+        the frames are saved in the shard under the filename of the video frame path
+        frame numbers is None if every frame gets extracted (see convertVideoToFrame)
+    threads - int, default = 0
+        number of threads ffmpeg may use for decoding and encoding, 0 lets ffmpeg decide
+    downscale_factors - list of int, default = [], see convertVideoToFrame
+"""
+def convertVideoToShard(video_path, frame_outputs, threads=0, downscale_factors=[]):
+    video_frame_dir = os.path.dirname(frame_outputs[0][0])
+    shard_path = getFrameShardPath(video_frame_dir, getFilenameWithoutPath(video_path))
+
+    print(f"Converting video = {video_path}")
+    print(f" To frame shard = {shard_path}")
+
+    vid_info = getVideoInfo(video_path)
+    print(f" h = {vid_info['height']}, w = {vid_info['width']}, vid length (in sec): {vid_info['duration']}")
+
+    # the shard has to contain the frames of every annotation
+    if any(frame_numbers == None for _, frame_numbers in frame_outputs):
+        decoded_frame_numbers = None
+        print(" Extracting every frame")
+    else:
+        decoded_frame_numbers = sorted(set(z for _, frame_numbers in frame_outputs for z in frame_numbers))
+        print(f" Extracting {len(decoded_frame_numbers)} frames")
+
+        if decoded_frame_numbers == []:
+            print(" No frame to extract")
+            return
+
+    # frame number -> the filenames of the frame, one for every annotation that has the frame
+    frame_filename_sets = [(os.path.basename(video_frame_path), None if frame_numbers == None else set(frame_numbers)) 
+                                for video_frame_path, frame_numbers in frame_outputs]
+    def getFrameFilenames(z):
+        return [frame_filename % z for frame_filename, frame_numbers in frame_filename_sets 
+                    if frame_numbers == None or z in frame_numbers]
+
+    shard_paths = [shard_path]
+    for d in downscale_factors:
+        downscaled_shard_path = getDownscaledFramePath(shard_path, d)
+        os.makedirs(os.path.dirname(downscaled_shard_path), exist_ok=True)
+        print(f" To downscaled (1/{d}) frame shard = {downscaled_shard_path}")
+
+        shard_paths.append(downscaled_shard_path)
+
+    # every output gets its own pipe, ffmpeg writes to pipe:{file descriptor}
+    pipes = [os.pipe() for _ in shard_paths]
+    filter_script_path = createFilterScriptPath() if decoded_frame_numbers != None else None
+    try:
+        process = subprocess.Popen(getFrameExtractionCommand(video_path, [f"pipe:{write_fd}" for _, write_fd in pipes], 
+                                                                threads, decoded_frame_numbers, downscale_factors, pipe=True, 
+                                                                filter_script_path=filter_script_path),
+                         stdout=subprocess.PIPE, 
+                         stderr=subprocess.PIPE,
+                         pass_fds=[write_fd for _, write_fd in pipes],
+                         universal_newlines=True)
+    except:
+        removeFilterScript(filter_script_path)
+        raise
+    finally:
+        for _, write_fd in pipes:
+            os.close(write_fd)
+
+    # the pipes have to be read at the same time, otherwise ffmpeg blocks on the first full one
+    #   frames are numbered in the order they come out: the selected frame numbers, or 0, 1, 2, ... for every frame
+    shard_writers = [FrameShardWriter(p) for p in shard_paths]
+    shard_errors = []
+    def writeShard(read_fd, shard_writer):
+        with os.fdopen(read_fd, "rb") as stream:
+            try:
+                frame_number_iter = iter(decoded_frame_numbers) if decoded_frame_numbers != None else count()
+                for z, frame_bytes in zip(frame_number_iter, iterJpegFrames(stream)):
+                    shard_writer.add(getFrameFilenames(z), frame_bytes)
+            except:
+                shard_errors.append(traceback.format_exc())
+
+            # keep reading until ffmpeg is done, so it never blocks on this pipe
+            while stream.read(READ_CHUNK_SIZE) != b"":
+                pass
+
+    shard_threads = [Thread(target=writeShard, args=(read_fd, shard_writer)) for (read_fd, _), shard_writer in zip(pipes, shard_writers)]
+    for shard_thread in shard_threads:
+        shard_thread.start()
 
     stdout, stderr = process.communicate()
+    removeFilterScript(filter_script_path)
     printStdOutput(stdout)
     printStdOutput(stderr)
 
+    for shard_thread in shard_threads:
+        shard_thread.join()
+
+    # the shards only get their name once every frame is in, so a failed conversion never leaves a partial shard behind
+    if process.returncode != 0 or shard_errors != []:
+        for shard_writer in shard_writers:
+            shard_writer.discard()
+
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {process.returncode} when converting video = {video_path}")
+
+    if shard_errors != []:
+        raise RuntimeError(f"frame shard of video = {video_path} could not be written\n" + "\n".join(shard_errors))
+
+    for shard_writer in shard_writers:
+        shard_writer.close()
+
+
+"""
+Run convertVideoToShard for ONE video, but instead of raising, return the error
+
+Parameters:
+    same as convertVideoToShard
+
+Return:
+    None if the conversion succeeded, otherwise the traceback of the error as a string
+"""
+def convertVideoToShardWithTrace(video_path, frame_outputs, threads=0, downscale_factors=[]):
+    try: 
+        convertVideoToShard(video_path, frame_outputs, threads, downscale_factors)
+        print()
+    except:
+        trace_error = traceback.format_exc()
+
+        print(trace_error)
+
+        print("xxxxxxxxxxx WARNING! xxxxxxxxxxx")
+        print(f"xxxxxxx video path = {video_path} xxxxxxx")
+        print()
+
+        return trace_error
+
+    return None
+
 
 """
 Generate a json that keeps track of
@@ -144,10 +495,22 @@ Parameters:
         - if there exist another via annotation jsons for the same video, 
             the via annotation json would just have "_2" at the end
     map_json_save_path - string, path (must include the filename) where we save the mapping
+    build_cache - BuildCache object, default = None
+        if given, the map is only generated again if the via json filenames or the code changed
 """
-def generatetVidToFileIdMap(via_json_dir, map_json_save_path):
+def generatetVidToFileIdMap(via_json_dir, map_json_save_path, build_cache=None):
     video_file_id_map = {"filenames": [], "id_map": {}}
 
+    if build_cache != None:
+        map_fingerprint = {
+                            "via_jsons": sorted(f for _, _, filenames in os.walk(via_json_dir) for f in filenames), 
+                            "code": codeFingerprint([os.path.abspath(__file__)]),
+                          }
+
+        if build_cache.isUpToDate("id_map", map_json_save_path, map_fingerprint, [map_json_save_path]):
+            print(f"{map_json_save_path} is up to date, skipping")
+            return
+
     for _, _, filenames in os.walk(via_json_dir):
         # sort ascending
         filenames_sorted = sorted(filenames)
@@ -177,6 +540,10 @@ def generatetVidToFileIdMap(via_json_dir, map_json_save_path):
     with open(map_json_save_path, "w") as f:
         json.dump(video_file_id_map, f)
 
+    if build_cache != None:
+        build_cache.record("id_map", map_json_save_path, map_fingerprint)
+        build_cache.save()
+
 
 """
 ====================================================================================================
@@ -186,6 +553,194 @@ def generatetVidToFileIdMap(via_json_dir, map_json_save_path):
 ====================================================================================================
 """
 
+"""
+Return the ffmpeg command that extracts the frames of the video at {video_path} (sampled at 10 fps), 
+    at full resolution and downscaled by every factor in {downscale_factors}
+
+Parameters:
+    video_path - string, path to the video file
+    output_paths - list of string, where ffmpeg writes the frames
+        first the full resolution, then one for every downscale factor
+    threads, frame_numbers, downscale_factors - see convertVideoToFrame
+    pipe - bool, default = False
+        if True, every output is a stream of jpgs (e.g. output path "pipe:1"), instead of numbered jpg files
+    filter_script_path - string, default = None
+        if given (and frame_numbers is not None), the filter graph is written to this file and ffmpeg reads it from there
+            (-filter_script:v or -filter_complex_script), instead of getting it as an argument:
+            the select expression has a term for every run of frames, so with isolated frames (e.g. negative samples)
+            on a long video it grows past the size limit of one command line argument
+"""
+def getFrameExtractionCommand(video_path, output_paths, threads=0, frame_numbers=None, downscale_factors=[], pipe=False, 
+                                filter_script_path=None):
+    if frame_numbers == None:
+        frame_filter = None
+        output_options = ['-r', '10']
+        naming_options = ['-start_number', '0']
+    else:
+        # sample at 10 fps, then only keep the selected frames
+        #   -frame_pts makes the frame number in the filename the timestamp in units of 0.1 sec, instead of a counter
+        frame_filter = f"fps=10,select='{getSelectExpression(frame_numbers)}'"
+        output_options = ['-vsync', '0']
+        naming_options = ['-frame_pts', '1']
+
+    if pipe:
+        output_options += ['-f', 'image2pipe', 
+                            '-c:v', 'mjpeg']
+    else:
+        output_options += naming_options
+
+    # -threads is given both as an input option (decoding) and as an output option (filtering and encoding)
+    command = ['ffmpeg',  '-threads', str(threads), 
+                            '-i', video_path]
+
+    if downscale_factors == []:
+        if frame_filter == None:
+            filter_options = []
+        elif filter_script_path != None:
+            filter_options = ['-filter_script:v', writeFilterScript(filter_script_path, frame_filter)]
+        else:
+            filter_options = ['-vf', frame_filter]
+        return command + filter_options + output_options + ['-threads', str(threads), output_paths[0]]
+
+    # decode (and select) once, then split into the full resolution and every downscaled resolution
+    num_outputs = len(downscale_factors) + 1
+    filter_complex = "[0:v]" + ("" if frame_filter == None else frame_filter + ",") + f"split={num_outputs}"
+    filter_complex += "".join(f"[v{i}]" for i in range(num_outputs))
+    for i, d in enumerate(downscale_factors, 1):
+        filter_complex += f";[v{i}]scale=trunc(iw/{d}):trunc(ih/{d})[s{i}]"
+
+    if frame_filter != None and filter_script_path != None:
+        command += ['-filter_complex_script', writeFilterScript(filter_script_path, filter_complex)]
+    else:
+        command += ['-filter_complex', filter_complex]
+
+    command += ['-map', '[v0]'] + output_options + ['-threads', str(threads), output_paths[0]]
+    for i, output_path in enumerate(output_paths[1:], 1):
+        command += ['-map', f'[s{i}]'] + output_options + ['-threads', str(threads), output_path]
+
+    return command
+
+
+"""
+Return the path of a new (empty) temporary file for an ffmpeg filter graph (see getFrameExtractionCommand)
+"""
+def createFilterScriptPath():
+    fd, filter_script_path = tempfile.mkstemp(prefix="frame_select_", suffix=".ffgraph")
+    os.close(fd)
+    return filter_script_path
+
+
+"""
+Write the filter graph {filter_graph} to {filter_script_path}, and return {filter_script_path}
+"""
+def writeFilterScript(filter_script_path, filter_graph):
+    with open(filter_script_path, "w") as f:
+        f.write(filter_graph)
+    return filter_script_path
+
+
+"""
+Remove the filter graph file at {filter_script_path}, if there is one
+"""
+def removeFilterScript(filter_script_path):
+    if filter_script_path != None and os.path.exists(filter_script_path):
+        os.remove(filter_script_path)
+
+
+"""
+Return the path to save the frames downscaled by {downscale_factor}, for the frames saved at {video_frame_path}:
+    the same filename in the directory downscale_{downscale_factor} next to the frames
+    (CustomCocoDataset with downscale_factor reads the frames from there)
+
+    e.g. ("./frames/DJI_0386_%05d.jpg", 4) -> "./frames/downscale_4/DJI_0386_%05d.jpg"
+"""
+def getDownscaledFramePath(video_frame_path, downscale_factor):
+    return os.path.join(os.path.dirname(video_frame_path), f"downscale_{downscale_factor}", os.path.basename(video_frame_path))
+
+
+"""
+Make {link_path} a link to the frame at {frame_path}, replacing whatever is at {link_path}
+
+Parameters:
+    frame_path - string, path of the extracted frame
+    link_path - string, path of the link
+    link_mode - string, "hardlink" or "symlink"
+        a hardlink falls back to a symlink if the filesystem does not support it
+"""
+def linkFrame(frame_path, link_path, link_mode="hardlink"):
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+
+    if link_mode == "hardlink":
+        try:
+            os.link(frame_path, link_path)
+            return
+        except OSError:
+            pass
+
+    # relative, so the frame directory can be moved as a whole
+    os.symlink(os.path.relpath(frame_path, os.path.dirname(link_path)), link_path)
+
+
+"""
+Return the frame numbers (in units of 0.1 sec) of the frames that have annotations, for the via annotation at {via_json_path}
+
+The annotated frames come from the image ids of the annotations in the converted coco json in {coco_json_dir},
+    so the same filtering as in the conversion applies (e.g. too small bounding boxes)
+    if the coco json does not exist, they come from the timestamps of the bounding boxes in the via json instead
+
+Parameters:
+    via_json_path - string, path to the via json
+    coco_json_dir - string, directory containing the converted coco jsons
+    video_path - string, path to the video, used to find the number of frames in the video
+    negative_fraction - float, default = 0.0
+        fraction of the frames without annotations that also get returned, as negative samples
+        they are picked at random, but always the same ones for the same via json
+
+Return:
+    sorted list of frame numbers
+"""
+def getFrameNumbersToExtract(via_json_path, coco_json_dir, video_path, negative_fraction=0.0):
+    coco_json_path = getCocoJsonSavePath(via_json_path, coco_json_dir)
+
+    if os.path.exists(coco_json_path):
+        with open(coco_json_path, "r") as f:
+            coco_json = json.load(f)
+
+        # the frame number is the last digits_for_frame digits of the image id
+        frame_numbers = set(decodeImageId(ann["image_id"])[1] for ann in coco_json["annotations"])
+    else:
+        with open(via_json_path, "r") as f:
+            via_json = json.load(f)
+
+        # if len of z is more than 1, not a bounding box annotation
+        frame_numbers = set(int(ann["z"][0] * 10) for ann in via_json["metadata"].values() if len(ann["z"]) == 1)
+
+    num_frames = ceil(getVideoInfo(video_path)["duration"] * 10)
+    frame_numbers = set(z for z in frame_numbers if z < num_frames)
+
+    # the same negative samples as in the coco json (see convertToCocoFormat)
+    frame_numbers.update(getNegativeFrameNumbers(frame_numbers, num_frames, negative_fraction, getFilenameWithoutPath(via_json_path)))
+
+    return sorted(frame_numbers)
+
+
+"""
+Return the expression for ffmpeg's select filter that keeps the frames in {frame_numbers} (sorted)
+
+Consecutive frame numbers are joined into one between(n,first,last), so the expression stays short
+"""
+def getSelectExpression(frame_numbers):
+    frame_ranges = []
+    for z in frame_numbers:
+        if frame_ranges != [] and frame_ranges[-1][1] + 1 == z:
+            frame_ranges[-1][1] = z
+        else:
+            frame_ranges.append([z, z])
+
+    return "+".join(f"between(n,{first},{last})" for first, last in frame_ranges)
+
+
 def printStdOutput(std_output):
     output_split = std_output.split('\n')
     for output in output_split:
@@ -0,0 +1,106 @@
+import subprocess
+from PIL import Image
+
+# if the next requested frame is at most this many frames (in units of 0.1 sec) ahead of the open ffmpeg process,
+#   the frames in between get decoded and thrown away instead of starting a new ffmpeg process at the requested frame
+MAX_SKIP_FRAMES = 50
+
+
+class VideoFrameReader:
+    """
+    Video Frame Reader decodes frames straight from a video, sampled at 10 fps like the frames extracted by
+        video2FrameConverter (frame number z is the frame at z * 0.1 sec)
+
+    The frames are decoded by an ffmpeg process that keeps running between calls,
+        so reading frames of the same video in increasing order only seeks once,
+        and every other frame is read from the same decoder
+
+    Parameters:
+        video_path - string, path to the video file
+        width - int, width of the frame in pixel
+        height - int, height of the frame in pixel
+        max_skip_frames - int, default = MAX_SKIP_FRAMES
+            how far ahead a requested frame can be before the reader seeks instead of decoding the frames in between
+        downscale_factor - int, default = 1
+            if larger than 1, the frames are scaled down by ffmpeg to width // downscale_factor and height // downscale_factor
+                (the same size as the frames extracted with that downscale factor)
+    """
+    def __init__(self, video_path, width, height, max_skip_frames=MAX_SKIP_FRAMES, downscale_factor=1):
+        self.video_path = video_path
+        self.width = width // downscale_factor
+        self.height = height // downscale_factor
+        self.max_skip_frames = max_skip_frames
+        self.downscale_factor = downscale_factor
+
+        # number of bytes of one rgb24 frame, as ffmpeg outputs it (after the downscale)
+        self.frame_size = self.width * self.height * 3
+
+        self.process = None
+        # frame number of the next frame the ffmpeg process outputs
+        self.next_frame_number = None
+
+
+    """
+    Return the frame at {frame_number} (in units of 0.1 sec) as a RGB PIL image
+    """
+    def readFrame(self, frame_number):
+        if (self.process == None
+                or frame_number < self.next_frame_number
+                or frame_number - self.next_frame_number > self.max_skip_frames):
+            self.seek(frame_number)
+
+        while self.next_frame_number < frame_number:
+            self.readRawFrame()
+
+        return Image.frombytes("RGB", (self.width, self.height), self.readRawFrame())
+
+
+    """
+    Start a new ffmpeg process that outputs the frames from {frame_number} on
+    """
+    def seek(self, frame_number):
+        self.close()
+
+        # -ss before -i seeks in the input (to the keyframe before, then decodes up to the timestamp)
+        #   fps=10 then samples the video at the same 0.1 sec steps as the frame extraction
+        video_filter = 'fps=10'
+        if self.downscale_factor > 1:
+            video_filter += f',scale={self.width}:{self.height}'
+
+        self.process = subprocess.Popen(['ffmpeg', '-loglevel', 'error',
+                                                    '-ss', str(frame_number / 10),
+                                                    '-i', self.video_path,
+                                                    '-vf', video_filter,
+                                                    '-f', 'rawvideo',
+                                                    '-pix_fmt', 'rgb24',
+                                                    'pipe:1'],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+        self.next_frame_number = frame_number
+
+
+    """
+    Read the next frame from the ffmpeg process as raw rgb24 bytes
+    """
+    def readRawFrame(self):
+        raw_frame = self.process.stdout.read(self.frame_size)
+
+        if len(raw_frame) != self.frame_size:
+            frame_number = self.next_frame_number
+            self.close()
+            raise IndexError(f"frame {frame_number} is past the end of video = {self.video_path}")
+
+        self.next_frame_number += 1
+        return raw_frame
+
+
+    """
+    Stop the ffmpeg process, if there is one
+    """
+    def close(self):
+        if self.process != None:
+            self.process.stdout.close()
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+            self.next_frame_number = None
@@ -0,0 +1,121 @@
+import os
+import json
+import tempfile
+import threading
+import ffmpeg
+
+"""
+Constant declaration (from config file)
+"""
+with open("./config.json", "r") as f:
+  config_json = json.load(f)
+
+VIDEO_PROBE_CACHE_PATH = config_json["video_probe_cache_path"]
+
+"""
+====================================================================================================
+
+    Main function to run
+      - getVideoInfo
+          if you want the width, height and duration of a video without probing it more than once
+
+====================================================================================================
+"""
+
+# in-memory copy of the probe cache json, loaded the first time it is needed
+video_probe_cache = None
+# guards video_probe_cache and the load/merge/save of the json, e.g. for the frame extraction jobs running in threads
+video_probe_cache_lock = threading.Lock()
+
+"""
+Return the width, height and duration of the video at {video_path}
+
+The result of ffmpeg.probe is saved in the probe cache json (VIDEO_PROBE_CACHE_PATH in the config file),
+  keyed by the absolute video path, and the video file's size and modification time.
+  As long as the video file does not change, the video will never get probed again,
+  even across different runs of the pipeline
+
+Parameter:
+  video_path - string, path to the video file
+
+Return:
+  dictionary with
+    "width" - int, width of the frame in pixel
+    "height" - int, height of the frame in pixel
+    "duration" - float, video length in seconds
+"""
+def getVideoInfo(video_path):
+  global video_probe_cache
+
+  video_key = os.path.abspath(video_path)
+  video_stat = os.stat(video_path)
+
+  with video_probe_cache_lock:
+    if video_probe_cache == None:
+      video_probe_cache = loadVideoProbeCache()
+
+    cache_entry = video_probe_cache.get(video_key)
+    if cache_entry != None and cache_entry["size"] == video_stat.st_size and cache_entry["mtime"] == video_stat.st_mtime_ns:
+      return cache_entry["info"]
+
+  # probed without holding the lock, so the threads probe different videos at the same time
+
+  vid_info = ffmpeg.probe(video_path)
+
+  # Source: https://stackoverflow.com/questions/7362130/getting-video-dimension-resolution-width-x-height-from-ffmpeg
+  # Source: https://stackoverflow.com/questions/3844430/how-to-get-the-duration-of-a-video-in-python
+  info = {
+          "width": int(vid_info['streams'][0]['width']),
+          "height": int(vid_info['streams'][0]['height']),
+          "duration": float(vid_info['format']['duration']),
+  }
+
+  # another process (e.g. a worker of convertAllViaToCoco) might have updated the cache in the meantime,
+  #   so merge with what is on disk before saving
+  with video_probe_cache_lock:
+    video_probe_cache = loadVideoProbeCache()
+    video_probe_cache[video_key] = {"size": video_stat.st_size, "mtime": video_stat.st_mtime_ns, "info": info}
+    saveVideoProbeCache(video_probe_cache)
+
+  return info
+
+
+"""
+====================================================================================================
+
+    Helper functions
+
+====================================================================================================
+"""
+
+"""
+Load the probe cache json, return an empty cache if it does not exist or cannot be read
+"""
+def loadVideoProbeCache():
+  if not os.path.exists(VIDEO_PROBE_CACHE_PATH):
+    return {}
+
+  try:
+    with open(VIDEO_PROBE_CACHE_PATH, "r") as f:
+      return json.load(f)
+  except ValueError:
+    print(f"WARNING: video probe cache = {VIDEO_PROBE_CACHE_PATH} cannot be read, starting a new one")
+    return {}
+
+
+"""
+Save the probe cache json
+
+The cache gets written to a temporary file (with a unique name, so concurrent writers never share it) first and then renamed,
+  so a reader (or a concurrent writer) never sees a half written cache
+"""
+def saveVideoProbeCache(cache):
+  cache_dir = os.path.dirname(VIDEO_PROBE_CACHE_PATH)
+  if cache_dir != "":
+    os.makedirs(cache_dir, exist_ok=True)
+
+  fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(VIDEO_PROBE_CACHE_PATH) + ".", suffix=".tmp", dir=cache_dir or ".")
+  with os.fdopen(fd, "w") as f:
+    json.dump(cache, f)
+
+  os.replace(tmp_path, VIDEO_PROBE_CACHE_PATH)